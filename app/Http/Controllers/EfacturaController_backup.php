@@ -373,8 +373,8 @@ public function status()
     private function startTunnelAsync(): void
     {
         // Start tunnel in background without blocking the response
-        if (file_exists(base_path('cloudflared/e.py'))) {
-            $command = "cd /d \"" . base_path('cloudflared') . "\" && start /B python e.py";
+        if (file_exists(base_path('cloudflared/tunnel.py'))) {
+            $command = "cd /d \"" . base_path('cloudflared') . "\" && start /B python tunnel.py supervise";
             shell_exec($command . ' > NUL 2>&1 &');
         }
     }
@@ -44,9 +44,9 @@ private function startCloudflaredTunnelAsync(): void
 
     private function startTunnelNonBlocking(): void
     {
-        $pythonScript = base_path('cloudflared/e.py');
+        $pythonScript = base_path('cloudflared/tunnel.py');
         if (file_exists($pythonScript)) {
-            $command = "cd /d \"" . base_path('cloudflared') . "\" && start /B python e.py";
+            $command = "cd /d \"" . base_path('cloudflared') . "\" && start /B python tunnel.py supervise";
             shell_exec($command . ' > NUL 2>&1 &');
         }
     }
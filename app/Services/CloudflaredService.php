@@ -12,6 +12,7 @@ class CloudflaredService
     private static $statusCache = null;
     private static $cacheTime = 0;
     private const CACHE_DURATION = 30; // Cache for 30 seconds
+    private const UP_STATES = ['running', 'starting']; // same as tunnel.py UP_STATES
 
     public function __construct()
     {
@@ -56,6 +57,14 @@ public function isRunning(): bool
     private function checkProcess(): bool
     {
         try {
+            // Fastest check: cached state served by `python tunnel.py supervise`
+            $status = $this->supervisorStatus();
+            if ($status !== null) {
+                // Same rule as `tunnel.py status`: a connector that is still
+                // starting counts as up, so we don't spawn a second one
+                return in_array($status['state'] ?? null, self::UP_STATES, true);
+            }
+
             // Primary check: Use Python script which is more reliable
             $pythonScript = base_path('cloudflared/tunnel.py');
             if (file_exists($pythonScript)) {
@@ -86,6 +95,21 @@ private function checkProcess(): bool
         }
     }
     
+    private function supervisorStatus(): ?array
+    {
+        $port = (int) config('services.cloudflared.status_port', 8766);
+        $context = stream_context_create(['http' => ['timeout' => 0.5]]);
+
+        $body = @file_get_contents("http://127.0.0.1:{$port}/status", false, $context);
+        if ($body === false) {
+            return null;
+        }
+
+        $data = json_decode($body, true);
+
+        return is_array($data) ? $data : null;
+    }
+
     private function verifyTunnelAccess(): bool
     {
         // Quick check if tunnel URL is accessible (301, 404 are acceptable - means tunnel is working)
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+# bench.py – offline benchmarks for e.py
+#
+#   python bench.py startup [--runs 10] [--ref old_e.py]
+#   python bench.py normalize [--msgs 100000]
+#   python bench.py run --cuis 5 --msgs 200 --workers 8 --rate 50 \
+#          --latency 0.02 --errors 500=0.02,401=0.01 --mix zip=90,broken=5,pdf=5
+#
+# ``run`` starts FakeAnaf – a local stand-in for listaMesajeFactura,
+# descarcare, transformare and the OAuth token endpoint – and drives e.py's
+# main() against it in a child process, so nothing touches production ANAF.
+
+import argparse, gc, io, json, os, pathlib, random, re, shutil, statistics, \
+       subprocess, sys, tempfile, threading, time, tracemalloc, zipfile
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+try:                                    # peak RSS of the child (POSIX only)
+    import resource
+except ImportError:
+    resource = None
+
+HERE = pathlib.Path(__file__).resolve().parent
+
+# ────────────────── cold start ───────────────────────────────────────────
+
+def _cold(script: pathlib.Path, args: list[str], runs: int) -> list[float]:
+    """Wall time of *runs* fresh interpreters running *script* with *args*."""
+    out = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        subprocess.run([sys.executable, str(script), *args], cwd=script.parent,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        out.append(time.perf_counter() - t)
+    return out
+
+
+def startup(a):
+    """Cold-start cost of ``e.py --help`` (argument parsing, no network).
+
+    ``--ref`` runs the same measurement against another copy of the script,
+    e.g. ``git show <rev>:cloudflared/e.py > old_e.py``.  The copy is run
+    from this directory so it sees the same cloudflared.exe / cert / .env.
+    """
+    rows = [("e.py", HERE / "e.py")]
+    if a.ref:
+        ref = pathlib.Path(a.ref).resolve()
+        tmp = HERE / f"_bench_{ref.name}"
+        tmp.write_bytes(ref.read_bytes())
+        rows.append((ref.name, tmp))
+    try:
+        print(f"{'script':<16}{'median':>10}{'min':>10}{'max':>10}")
+        for name, path in rows:
+            t = _cold(path, ["--help"], a.runs)
+            print(f"{name:<16}{statistics.median(t) * 1e3:>8.0f}ms"
+                  f"{min(t) * 1e3:>8.0f}ms{max(t) * 1e3:>8.0f}ms")
+    finally:
+        if a.ref:
+            tmp.unlink(missing_ok=True)
+
+# ────────────────── listing normalisation ────────────────────────────────
+
+def _listing(cui: str, n: int) -> list[dict]:
+    """*n* messages shaped like ``listaMesajeFactura`` entries."""
+    now = time.strftime("%Y%m%d")
+    return [{"data_creare": f"{now}{i % 24:02d}{i % 60:02d}", "cif": cui,
+             "id_solicitare": f"{cui}{i:06d}", "detalii": f"Factura {i}",
+             "tip": "FACTURA PRIMITA" if i % 2 else "FACTURA TRIMISA",
+             "id": f"9{cui}{i:06d}"} for i in range(n)]
+
+
+def _legacy(e, body: bytes, cui: str, root: pathlib.Path) -> list:
+    """main()'s per-message work before ``Msg`` records, for comparison."""
+    def when(dc):
+        digits = re.sub(r"\D", "", dc or "")[:12]
+        try:
+            return datetime.strptime(digits.ljust(12, "0"), "%Y%m%d%H%M") \
+                if len(digits) >= 8 else None
+        except ValueError:
+            return None
+
+    out = []
+    for m in (d for d in json.loads(body)["mesaje"] if e._ensure_dict(d)):
+        m = e._ensure_dict(m)
+        mid = e._extract_id(m)
+        t = when(m.get("data_creare"))
+        slot = e.TIP2DIR.get(m.get("tip"), "Erori")
+        day = (m.get("data_creare") or "")[:10] \
+            or datetime.now(timezone.utc).date().isoformat()
+        month = day[5:7] if len(day) >= 7 else "NA"
+        out.append((mid, m, t, slot, root / day[:4] / cui / slot / month / f"{day}_{mid}"))
+    return out
+
+
+def normalize(a):
+    """Decode + normalise one synthetic *msgs*-entry listing, old vs new.
+
+    Reports the best of *runs* wall times and the memory the resulting
+    per-message objects keep alive.
+    """
+    sys.path.insert(0, str(HERE))
+    import e
+    cui, root = "10000000", pathlib.Path("out")
+    body = json.dumps({"mesaje": _listing(cui, a.msgs)}).encode()
+    rows = [("legacy dicts", lambda: _legacy(e, body, cui, root)),
+            ("Msg records", lambda: [r for m in e._loads(body)["mesaje"]
+                                     if (r := e._record(m, cui))])]
+    print(f"{a.msgs} messages, {len(body) / 1e6:.1f} MB JSON, decoder "
+          f"{e._loads.__module__}")
+    print(f"{'path':<16}{'best':>10}{'per msg':>10}{'kept':>10}")
+    for name, fn in rows:
+        best = float("inf")
+        for _ in range(a.runs):
+            gc.collect()
+            t = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - t)
+        gc.collect()
+        tracemalloc.start()
+        keep = fn()
+        kept = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del keep
+        print(f"{name:<16}{best * 1e3:>8.0f}ms{best / a.msgs * 1e6:>8.2f}µs"
+              f"{kept / 2**20:>7.1f}MiB")
+
+# ────────────────── fake ANAF ────────────────────────────────────────────
+
+def _weights(s: str) -> dict[str, float]:
+    """``"zip=90,pdf=5"`` → ``{"zip": 90.0, "pdf": 5.0}``."""
+    return {k: float(v) for k, _, v in (p.partition("=") for p in s.split(",") if p)}
+
+
+class _Server(ThreadingHTTPServer):
+    """Doesn't print a traceback when the client hangs up mid-answer – e.py
+    drops the connection after a 5xx/429 and on every retry."""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeAnaf:
+    """Threaded local HTTP server that answers like the e-Factura API.
+
+    • *cuis* × *msgs* messages, ids unique per CUI
+    • *latency* ± *jitter* seconds before every answer
+    • *errors* maps status → probability per request (400/401/404/429/500/503);
+      a 401 means the client has to go through the token endpoint
+    • *capacity* maps endpoint → requests/s it tolerates; past that it
+      answers 429 with ``Retry-After: 1``
+    • *mix* weights the payload kind per message: zip, pdf, xml, broken
+    • *size* pads every XML invoice to about that many bytes
+    • the paginated listing returns *page_size* messages per page
+    """
+
+    def __init__(self, cuis: list[str], msgs: int, latency: float = 0.0,
+                 jitter: float = 0.0, errors: dict | None = None,
+                 mix: dict | None = None, size: int = 4096, seed: int = 1,
+                 page_size: int = 500, capacity: dict | None = None):
+        self.cuis, self.msgs, self.latency, self.jitter = cuis, msgs, latency, jitter
+        self.errors = errors or {}
+        self.mix = mix or {"zip": 1}
+        self.size, self.seed, self.page_size = size, seed, page_size
+        self.capacity = capacity or {}
+        self._cap: dict[str, list[float]] = {}     # ep → [tokens, last refill]
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.hits: dict[str, int] = {}
+        self.srv = _Server(("127.0.0.1", 0), self._handler())
+
+    @property
+    def base(self) -> str:
+        return f"http://127.0.0.1:{self.srv.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.srv.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.srv.shutdown()
+        self.srv.server_close()
+
+    def listing(self, cui: str) -> list[dict]:
+        return _listing(cui, self.msgs)
+
+    def page(self, cui: str, page: int) -> dict:
+        """One page of ``listaMesajePaginatieFactura``."""
+        msgs  = self.listing(cui)
+        if not msgs:
+            return {"eroare": "Nu exista mesaje in intervalul selectat"}
+        pages = -(-len(msgs) // self.page_size)
+        return {"mesaje": msgs[(page - 1) * self.page_size: page * self.page_size],
+                "numar_total_inregistrari": len(msgs),
+                "numar_total_inregistrari_per_pagina": self.page_size,
+                "numar_total_pagini": pages, "index_pagina_curenta": page}
+
+    def payload(self, mid: str) -> tuple[bytes, str]:
+        kinds = list(self.mix)
+        kind  = random.Random(f"{self.seed}:{mid}").choices(kinds, [self.mix[k] for k in kinds])[0]
+        xml   = (f'<?xml version="1.0"?><Invoice><ID>{mid}</ID>'
+                 f'<!--{"x" * max(self.size - 80, 0)}--></Invoice>').encode()
+        if kind == "pdf":
+            return b"%PDF-1.4\n" + xml, "application/pdf"
+        if kind == "xml":
+            return xml, "application/xml"
+        b = io.BytesIO()
+        with zipfile.ZipFile(b, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr(f"{mid}.xml", xml)
+            z.writestr(f"semnatura_{mid}.xml", b"<Signature/>")
+        blob = b.getvalue()
+        if kind == "broken":
+            blob = blob[: len(blob) // 2]
+        return blob, "application/zip"
+
+    def _over(self, ep: str) -> bool:
+        """True if *ep* is past its capacity (token bucket, burst 1)."""
+        rate = self.capacity.get(ep)
+        if not rate:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            b = self._cap.setdefault(ep, [1.0, now])
+            b[0], b[1] = min(1.0, b[0] + (now - b[1]) * rate), now
+            if b[0] < 1:
+                return True
+            b[0] -= 1
+            return False
+
+    def _fault(self) -> int | None:
+        with self._lock:
+            r = self._rnd.random()
+        for code, p in self.errors.items():
+            if r < p:
+                return int(code)
+            r -= p
+        return None
+
+    def _handler(self):
+        fake = self
+
+        class H(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *_): ...
+
+            def _send(self, code: int, body: bytes = b"", ctype="application/json"):
+                self.send_response(code)
+                if code in (429, 503):
+                    self.send_header("Retry-After", "1")
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _enter(self, ep: str) -> bool:
+                with fake._lock:
+                    fake.hits[ep] = fake.hits.get(ep, 0) + 1
+                if fake.latency or fake.jitter:
+                    time.sleep(max(0.0, fake.latency + random.uniform(-fake.jitter, fake.jitter)))
+                if ep != "TOKEN" and fake._over(ep):
+                    self._send(429, b'{"eroare": "prea multe cereri"}')
+                    return False
+                if ep != "TOKEN" and (code := fake._fault()):
+                    self._send(code, b'{"eroare": "fake"}')
+                    return False
+                return True
+
+            def do_GET(self):
+                u = urlparse(self.path)
+                q = {k: v[0] for k, v in parse_qs(u.query).items()}
+                if u.path.endswith("/listaMesajeFactura"):
+                    if self._enter("LISTA"):
+                        self._send(200, json.dumps({"mesaje": fake.listing(q.get("cif", ""))}).encode())
+                elif u.path.endswith("/listaMesajePaginatieFactura"):
+                    if self._enter("LISTA"):
+                        self._send(200, json.dumps(fake.page(q.get("cif", ""),
+                                                             int(q.get("pagina", 1)))).encode())
+                elif u.path.endswith("/descarcare"):
+                    if self._enter("DESCA"):
+                        self._send(200, *fake.payload(q.get("id", "")))
+                else:
+                    self._send(404)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if "/transformare/" in self.path:
+                    if self._enter("TRANS"):
+                        self._send(200, b"%PDF-1.4\n" + body[:64], "application/pdf")
+                elif self.path.endswith("/token"):
+                    self._enter("TOKEN")
+                    self._send(200, json.dumps({"access_token": f"fake{time.time_ns()}",
+                                                "refresh_token": "fake-refresh",
+                                                "expires_in": 3600}).encode())
+                else:
+                    self._send(404)
+
+        return H
+
+# ────────────────── end-to-end run ──────────────────────────────────────
+
+_CHILD = """
+import json, pathlib, sys
+sys.path.insert(0, {here!r})
+import e
+base = {base!r}
+e.API_BASE  = base
+e.LISTA     = base + "/listaMesajeFactura"
+e.LISTA_PAG = base + "/listaMesajePaginatieFactura"
+e.DESCA     = base + "/descarcare"
+e.TRANS     = base + "/transformare/{{std}}/{{novld}}"
+e.TOKEN_URL = base + "/token"
+e.CID = e.CSEC = "bench"
+e.RATES_FILE = pathlib.Path("rates.json")
+e.COORD_FILE = pathlib.Path("coord.db")
+e._TOKENS = e.TokenStore(pathlib.Path({tokens!r}))
+sys.argv = ["e.py"] + json.loads({argv!r})
+e.main()
+"""
+
+
+def _tree(root: pathlib.Path) -> tuple[int, int]:
+    """(files, bytes) under *root*."""
+    n = size = 0
+    for dp, _, files in os.walk(root):
+        for f in files:
+            n += 1
+            size += os.path.getsize(os.path.join(dp, f))
+    return n, size
+
+
+def run(a):
+    cuis = [str(10_000_000 + i) for i in range(a.cuis)]
+    fake = FakeAnaf(cuis, a.msgs, a.latency, a.jitter, _weights(a.errors),
+                    _weights(a.mix), a.size, page_size=a.page_size,
+                    capacity=_weights(a.capacity)).start()
+    work = pathlib.Path(a.keep or tempfile.mkdtemp(prefix="efbench-"))
+    work.mkdir(parents=True, exist_ok=True)
+    tokens = work / "tokens.json"
+    tokens.write_text(json.dumps({"access_token": "fake", "refresh_token": "fake-refresh",
+                                  "expires_at": int(time.time()) + 86400}))
+    log  = work / "requests.jsonl"
+    argv = ["--cui", *cuis, "--dest", str(work / "out"), "--workers", str(a.workers),
+            "--rate", str(a.rate), "--burst", str(a.burst), "--metrics-log", str(log),
+            *a.extra]
+    code = _CHILD.format(here=str(HERE), base=fake.base, tokens=str(tokens),
+                         argv=json.dumps(argv))
+    t = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", code], cwd=work,
+                          stdout=None if a.verbose else subprocess.DEVNULL)
+    wall = time.perf_counter() - t
+    fake.stop()
+
+    lat = {}
+    for line in log.read_text().splitlines() if log.exists() else ():
+        r = json.loads(line)
+        lat.setdefault(r["ep"], []).append(r["lat"])
+    files, size = _tree(work / "out")
+    total = a.cuis * a.msgs
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if resource else None
+    if rss and sys.platform == "darwin":
+        rss //= 1024                        # bytes on macOS, KiB elsewhere
+
+    print(f"exit {proc.returncode}  wall {wall:.2f}s  {total} msgs  "
+          f"{total / wall:.1f} msg/s  peak RSS "
+          f"{f'{rss / 1024:.1f} MiB' if rss else 'n/a'}  disk {size / 1e6:.2f} MB in {files} files")
+    print(f"{'endpoint':<8}{'hits':>7}{'req':>7}{'p50':>9}{'p99':>9}")
+    for ep in sorted(set(lat) | set(fake.hits)):
+        v = sorted(lat.get(ep, []))
+        q = lambda p: v[min(len(v) - 1, int(p * len(v)))] * 1e3 if v else 0.0
+        print(f"{ep:<8}{fake.hits.get(ep, 0):>7}{len(v):>7}{q(.5):>7.1f}ms{q(.99):>7.1f}ms")
+    if not a.keep:
+        shutil.rmtree(work, ignore_errors=True)
+    else:
+        print(f"kept → {work}")
+
+# ────────────────── CLI ──────────────────────────────────────────────────
+
+def main():
+    pa = argparse.ArgumentParser("e.py benchmarks")
+    sub = pa.add_subparsers(dest="cmd", required=True)
+
+    st = sub.add_parser("startup", help="cold start of e.py")
+    st.add_argument("--runs", type=int, default=10)
+    st.add_argument("--ref", help="another e.py to compare against")
+    st.set_defaults(fn=startup)
+
+    nm = sub.add_parser("normalize", help="listing decode + per-message normalisation")
+    nm.add_argument("--msgs", type=int, default=100_000)
+    nm.add_argument("--runs", type=int, default=5)
+    nm.set_defaults(fn=normalize)
+
+    rn = sub.add_parser("run", help="end-to-end run against a local fake ANAF")
+    rn.add_argument("--cuis", type=int, default=3)
+    rn.add_argument("--msgs", type=int, default=100, help="messages per CUI")
+    rn.add_argument("--workers", type=int, default=8)
+    rn.add_argument("--rate", type=float, default=200)
+    rn.add_argument("--burst", type=float, default=20)
+    rn.add_argument("--latency", type=float, default=0.02, help="seconds per answer")
+    rn.add_argument("--jitter", type=float, default=0.01)
+    rn.add_argument("--errors", default="", help="e.g. 500=0.02,401=0.01,404=0.01")
+    rn.add_argument("--mix", default="zip=90,xml=4,pdf=4,broken=2")
+    rn.add_argument("--size", type=int, default=4096, help="XML invoice size in bytes")
+    rn.add_argument("--capacity", default="", metavar="EP=RATE,…",
+                    help="requests/s the fake tolerates per endpoint, e.g. DESCA=5")
+    rn.add_argument("--page-size", type=int, default=500, help="messages per listing page")
+    rn.add_argument("--keep", metavar="DIR", help="work in DIR and keep it")
+    rn.add_argument("-v", "--verbose", action="store_true", help="show e.py output")
+    rn.add_argument("extra", nargs=argparse.REMAINDER,
+                    help="further e.py arguments after --, e.g. -- --pdf")
+    rn.set_defaults(fn=run)
+
+    a = pa.parse_args()
+    if getattr(a, "extra", None) and a.extra[0] == "--":
+        a.extra = a.extra[1:]
+    a.fn(a)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 # efactura_downloader.py – Cloudflare tunnel + ANAF helper (2025-07-14)
 
-import argparse, base64, io, json, os, pathlib, queue, re, shutil, subprocess, \
-       sys, textwrap, threading, time, urllib.request, zipfile, requests
+import argparse, base64, contextlib, csv, hashlib, json, os, pathlib, queue, random, re, \
+       shutil, socket, sqlite3, struct, subprocess, sys, textwrap, threading, time, warnings, zipfile, zlib, requests
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from datetime import datetime, timezone                 # ★ added timezone
+from email.utils import parsedate_to_datetime
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import parse_qs, urlparse, urlencode
+from xml.etree import ElementTree as ET
 import webbrowser, pprint
 from dotenv import load_dotenv
 import re, json 
 
+try:                                    # faster listing decoder, if installed
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
+
 # ───────────────────────── CONFIG ────────────────────────────────────────
 ROOT, HOST, TUN_NAME, PORT, RATE = (
     "scyte.ro", "efactura.scyte.ro", "efactura", 8765, 2.0
@@ -21,9 +30,12 @@ CERT       = HERE / "cert.pem"
 CRED_JSON  = HERE / "efactura.json"      # static JSON creds
 TOK_FILE   = HERE / "efactura.token"     # run-token
 JWT_FILE   = HERE / "tokens.json"        # ANAF access / refresh JWTs
+RATES_FILE = HERE / "rates.json"         # learned per-endpoint rates (--adaptive)
+COORD_FILE = HERE / "coord.db"           # rate limit + leases shared by all e.py
 
 API_BASE   = "https://api.anaf.ro/prod/FCTEL/rest"
 LISTA      = f"{API_BASE}/listaMesajeFactura"
+LISTA_PAG  = f"{API_BASE}/listaMesajePaginatieFactura"
 DESCA      = f"{API_BASE}/descarcare"
 TRANS      = f"{API_BASE}/transformare/{{std}}/{{novld}}"
 TEST_HELLO = "https://api.anaf.ro/TestOauth/jaxrs/hello?name=hello"
@@ -32,6 +44,7 @@ AUTH_URL   = "https://logincert.anaf.ro/anaf-oauth2/v1/authorize"
 TOKEN_URL  = "https://logincert.anaf.ro/anaf-oauth2/v1/token"
 
 TIMEOUT, CHUNK = 30, 1 << 20
+READY_TIMEOUT = float(os.getenv("TUNNEL_READY_TIMEOUT", "30"))   # connector
 TIP2DIR = {"FACTURA PRIMITA": "Primite", "FACTURA TRIMISA": "Trimise"}
 
 load_dotenv(HERE / ".env")
@@ -48,19 +61,588 @@ _id_regex = re.compile(
     re.IGNORECASE | re.VERBOSE,
 )
 
-_last = 0.0
+class TokenBucket:
+    """Thread-safe token bucket: *rate* tokens/s, at most *burst* banked.
+
+    Callers reserve a token up front (the balance may go negative) and then
+    sleep outside the lock, so concurrent waiters queue up fairly.
+    """
+
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate, self.burst = float(rate), float(burst)
+        self._tokens, self._t = self.burst, time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, n: float = 1) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._t) * self.rate) - n
+            self._t = now
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class AdaptiveBucket:
+    """Rate limiter whose rate follows ANAF's answers (AIMD).
+
+    • healthy answer → rate += *step* / rate, i.e. about +*step* req/s per
+      second of traffic
+    • 429 / 503 → rate halves and nothing is sent for ``Retry-After`` (or
+      one interval); other 5xx and connection errors → rate × 0.8
+    • one cut per episode: answers to requests already in flight when the
+      rate was cut don't cut it again
+    • the rate stays within [*lo*, *hi*]; ``learned`` is what the next run
+      should start from – just under the rate that last drew a 429
+
+    Slots are handed out on a virtual schedule (GCRA) rather than from a
+    token balance, so a rate change never lets later callers overtake the
+    ones already waiting.
+    """
+
+    def __init__(self, rate: float, burst: float = 1, lo: float = 0.05,
+                 hi: float = 20.0, step: float = 0.5):
+        self.lo, self.hi, self.step, self.burst = lo, hi, step, float(burst)
+        self.rate = min(max(float(rate), lo), hi)
+        self.peak, self._quiet = None, 0.0
+        self._tat = time.monotonic()            # next free slot
+        self._lock = threading.Lock()
+
+    @property
+    def learned(self) -> float:
+        return max(self.rate, 0.9 * self.peak) if self.peak else self.rate
+
+    def take(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._tat, now - (self.burst - 1) / self.rate)
+            self._tat = slot + 1 / self.rate
+            wait = max(0.0, slot - now)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def feedback(self, status: int | None, retry_after: float | None = None):
+        with self._lock:
+            rate, now = self.rate, time.monotonic()
+            if status in (429, 503):
+                pause = retry_after if retry_after is not None else 1 / rate
+                if now >= self._quiet:
+                    self.peak, self._quiet = rate, now + pause + 1 / rate
+                    self.rate = max(self.lo, rate * 0.5)
+                self._tat = max(self._tat, now + pause)
+            elif status is None or status >= 500:
+                if now >= self._quiet:
+                    self._quiet = now + 1 / rate
+                    self.rate = max(self.lo, rate * 0.8)
+            elif rate < self.hi:
+                self.rate = min(self.hi, rate + self.step / rate)
+
+
+class Limiter:
+    """Global bucket plus optional per-endpoint budgets (LISTA, DESCA, TRANS).
+
+    Budgets that are :class:`AdaptiveBucket` are steered by ``feedback``;
+    with *shared* the global bucket and the fixed budgets are held in a
+    :class:`Coordinator` and apply to all processes together.
+    """
+
+    def __init__(self, rate: float, burst: float = 1,
+                 budgets: dict[str, tuple[float, float]] | None = None,
+                 adaptive: dict[str, AdaptiveBucket] | None = None,
+                 shared: "Coordinator | None" = None):
+        bucket = (lambda name, *a: SharedBucket(shared, name, *a)) if shared \
+            else (lambda name, *a: TokenBucket(*a))
+        self.glob = bucket("ALL", rate, burst)
+        self.ep = {k: bucket(k, *v) for k, v in (budgets or {}).items()}
+        self.ep.update(adaptive or {})
+
+    def acquire(self, ep: str) -> float:
+        b = self.ep.get(ep)
+        return (b.take() if b else 0.0) + self.glob.take()
+
+    def feedback(self, ep: str, status: int | None, retry_after: float | None = None):
+        b = self.ep.get(ep)
+        if isinstance(b, AdaptiveBucket):
+            b.feedback(status, retry_after)
+
+    def rates(self) -> dict[str, float]:
+        """Learned rate of every adaptive endpoint."""
+        return {k: round(b.learned, 3) for k, b in self.ep.items()
+                if isinstance(b, AdaptiveBucket)}
+
+
+_LIMIT = Limiter(1 / RATE)
+
 
-def _rate():
-    global _last
-    d = RATE - (time.monotonic() - _last)
-    if d > 0:
-        time.sleep(d)
-    _last = time.monotonic()
+def _endpoint(u: str) -> str:
+    """Map a request URL to its budget name."""
+    for name, url in (("LISTA", LISTA), ("LISTA", LISTA_PAG), ("DESCA", DESCA),
+                      ("TRANS", TRANS.split("{")[0]), ("TOKEN", TOKEN_URL)):
+        if u.startswith(url):
+            return name
+    return "OTHER"
+
+
+def _rate(ep: str = "OTHER"):
+    t = time.perf_counter()
+    wait = _LIMIT.acquire(ep)
+    if _TRACE and wait > 0:
+        _TRACE.complete("_rate", t, time.perf_counter() - t, ep=ep)
+    return wait
+
+
+def _load_rates() -> dict[str, float]:
+    try:
+        return {k: float(v) for k, v in json.loads(RATES_FILE.read_text()).items()}
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def _save_rates(rates: dict[str, float]):
+    """Merge *rates* into RATES_FILE (temp file + rename)."""
+    if not rates:
+        return
+    tmp = RATES_FILE.with_name(f".{RATES_FILE.name}.part")
+    tmp.write_text(json.dumps({**_load_rates(), **rates}, indent=2))
+    os.replace(tmp, RATES_FILE)
+
+
+def _retry_after(r) -> float | None:
+    """``Retry-After`` of response *r* in seconds (delta or HTTP date)."""
+    v = r.headers.get("Retry-After")
+    if not v:
+        return None
+    try:
+        return max(0.0, float(v))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(v).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# ────────────────── cross-process coordination ──────────────────────────
+
+class Coordinator:
+    """Rate-limit slots and work leases shared by every e.py using *path*.
+
+    • ``slot()`` is a GCRA bucket kept in SQLite (wall-clock time), so all
+      processes together stay within one rate
+    • ``lease(key)`` lets one process at a time work on a CUI or message;
+      leases expire after *ttl* unless the heartbeat thread renews them, so
+      a killed process frees its work.  Message leases released with
+      ``done=True`` stay behind as "already downloaded" for a day.
+    • keys are scoped to *scope* (the download folder): processes writing
+      to different trees don't block each other
+
+    Rollback-journal mode rather than WAL, so the file also works on a
+    volume shared by several machines (their clocks should agree).
+    """
+
+    def __init__(self, path: pathlib.Path, scope: str = "", ttl: float = 120):
+        self.scope, self.ttl = scope, ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=DELETE")
+        self.db.execute("CREATE TABLE IF NOT EXISTS bucket (name TEXT PRIMARY KEY, tat REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS lease ("
+                        "key TEXT PRIMARY KEY, owner TEXT, expires REAL, state TEXT)")
+        self.db.execute("DELETE FROM lease WHERE expires < ?", (time.time() - 86_400,))
+        self._lock, self._held = threading.Lock(), set()
+        self._stop = threading.Event()
+        self._th: threading.Thread | None = None
+
+    def _tx(self, fn):
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                out = fn(self.db)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return out
+
+    def slot(self, name: str, rate: float, burst: float = 1) -> float:
+        """Reserve the next send slot of bucket *name*; seconds to wait for it."""
+        def _take(db):
+            now = time.time()
+            row = db.execute("SELECT tat FROM bucket WHERE name=?", (name,)).fetchone()
+            slot = max(row[0] if row else now, now - (burst - 1) / rate)
+            db.execute("INSERT OR REPLACE INTO bucket VALUES (?, ?)", (name, slot + 1 / rate))
+            return max(0.0, slot - now)
+        return self._tx(_take)
+
+    def lease(self, key: str, force: bool = False) -> str | None:
+        """Take *key*; ``None`` on success, else who has it (or ``"done"``).
+        With *force* a "done" marker is taken over (``verify --repair``)."""
+        key = f"{self.scope}|{key}"
+
+        def _take(db):
+            now = time.time()
+            row = db.execute("SELECT owner, expires, state FROM lease WHERE key=?",
+                             (key,)).fetchone()
+            if row and row[0] != self.owner and (
+                    row[1] > now if row[2] != "done" else not force):
+                return "done" if row[2] == "done" else row[0]
+            db.execute("INSERT OR REPLACE INTO lease VALUES (?, ?, ?, 'held')",
+                       (key, self.owner, now + self.ttl))
+        who = self._tx(_take)
+        if who is None:
+            self._held.add(key)
+        return who
+
+    def release(self, key: str, done: bool = False):
+        key = f"{self.scope}|{key}"
+        self._held.discard(key)
+        if done:
+            self._tx(lambda db: db.execute(
+                "UPDATE lease SET state='done', expires=? WHERE key=? AND owner=?",
+                (time.time(), key, self.owner)))
+        else:
+            self._tx(lambda db: db.execute(
+                "DELETE FROM lease WHERE key=? AND owner=?", (key, self.owner)))
+
+    def _beat(self):
+        while not self._stop.wait(self.ttl / 3):
+            self._tx(lambda db: db.execute(
+                "UPDATE lease SET expires=? WHERE owner=? AND state='held'",
+                (time.time() + self.ttl, self.owner)))
+
+    def start(self):
+        self._th = threading.Thread(target=self._beat, name="leases", daemon=True)
+        self._th.start()
+
+    def close(self):
+        """Stop renewing and drop every lease still held."""
+        self._stop.set()
+        if self._th:
+            self._th.join()
+        self._tx(lambda db: db.execute(
+            "DELETE FROM lease WHERE owner=? AND state='held'", (self.owner,)))
+        with self._lock:
+            self.db.close()
+
+
+class SharedBucket:
+    """``TokenBucket`` stand-in whose schedule lives in a :class:`Coordinator`."""
+
+    def __init__(self, coord: Coordinator, name: str, rate: float, burst: float = 1):
+        self.coord, self.name, self.rate, self.burst = coord, name, float(rate), float(burst)
+
+    def take(self) -> float:
+        wait = self.coord.slot(self.name, self.rate, self.burst)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+# ────────────────── pooled keep-alive sessions ───────────────────────────
+
+class HttpPool:
+    """One keep-alive ``requests.Session`` per host, shared by all workers.
+
+    Connection resets, 429 and 5xx answers are retried up to *retries* times
+    with jittered exponential backoff, or after ``Retry-After`` when the
+    server sends one; *pace* (the rate limiter) runs before every attempt so
+    retries spend quota like any other request, and *feedback* sees the
+    outcome of every attempt (status or ``None``, Retry-After).
+    """
+
+    def __init__(self, size: int = 10, retries: int = 3,
+                 backoff: float = 0.5, timeout: float = TIMEOUT):
+        self.size, self.retries, self.backoff, self.timeout = \
+            size, retries, backoff, timeout
+        self._s: dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def session(self, host: str) -> requests.Session:
+        with self._lock:
+            s = self._s.get(host)
+            if s is None:
+                s = self._s[host] = requests.Session()
+                ad = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                   pool_maxsize=self.size,
+                                                   pool_block=True)
+                s.mount("https://", ad)
+                s.mount("http://", ad)
+                s.headers["Connection"] = "keep-alive"
+            return s
+
+    def request(self, m, u, pace=None, retries=None, feedback=None, **k):
+        k.setdefault("timeout", self.timeout)
+        tries = self.retries if retries is None else retries
+        s = self.session(urlparse(u).netloc)
+        for n in range(tries + 1):
+            if pace:
+                pace()
+            delay = None
+            try:
+                r = s.request(m, u, **k)
+            except (requests.ConnectionError, requests.Timeout):
+                if feedback:
+                    feedback(None, None)
+                if n == tries:
+                    raise
+            else:
+                delay = _retry_after(r)
+                if feedback:
+                    feedback(r.status_code, delay)
+                if (r.status_code < 500 and r.status_code != 429) or n == tries:
+                    return r
+                r.close()
+            time.sleep(min(delay, 300) if delay is not None
+                       else self.backoff * 2 ** n * random.uniform(0.5, 1.5))
+
+    def close(self):
+        with self._lock:
+            for s in self._s.values():
+                s.close()
+            self._s.clear()
+
+
+_HTTP = HttpPool()
+
+# ────────────────── request metrics ─────────────────────────────────────
+
+class Metrics:
+    """Per-endpoint request counters filled in by ``_req``.
+
+    Latency is the time spent in HTTP (backoff included, limiter waits
+    excluded); limiter waits are tracked separately as ``wait``.  With a
+    *log* path every request is also appended there as one JSON line.
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf"))
+
+    def __init__(self, log: pathlib.Path | None = None):
+        self._lock = threading.Lock()
+        self.ep: dict[str, dict] = {}
+        self._log = open(log, "a", encoding="utf-8") if log else None
+
+    def _row(self, ep: str) -> dict:
+        row = self.ep.get(ep)
+        if row is None:
+            row = self.ep[ep] = dict(n=0, lat=[], hist=[0] * len(self.BUCKETS),
+                                     wait=0.0, bytes_in=0, bytes_out=0,
+                                     status={}, retries=0, refreshes=0, hits=0)
+        return row
+
+    def observe(self, ep: str, status, lat: float, wait: float = 0.0,
+                bytes_in: int = 0, bytes_out: int = 0, retries: int = 0):
+        with self._lock:
+            row = self._row(ep)
+            row["n"] += 1
+            row["lat"].append(lat)
+            row["hist"][next(i for i, b in enumerate(self.BUCKETS) if lat <= b)] += 1
+            row["wait"] += wait
+            row["bytes_in"] += bytes_in
+            row["bytes_out"] += bytes_out
+            row["status"][str(status)] = row["status"].get(str(status), 0) + 1
+            row["retries"] += retries
+            if self._log:
+                self._log.write(json.dumps({
+                    "t": round(time.time(), 3), "ep": ep, "status": status,
+                    "lat": round(lat, 4), "wait": round(wait, 4),
+                    "in": bytes_in, "out": bytes_out, "retries": retries}) + "\n")
+
+    def add(self, ep: str, **inc):
+        """Bump plain counters, e.g. ``add("DESCA", bytes_in=n)``."""
+        with self._lock:
+            row = self._row(ep)
+            for k, v in inc.items():
+                row[k] += v
+
+    def summary(self) -> str:
+        head = (f"{'endpoint':<8}{'req':>7}{'p50':>8}{'p99':>8}{'max':>8}"
+                f"{'wait':>9}{'MB in':>9}{'MB out':>8}{'retry':>6}{'refr':>5}{'hit':>6}  status")
+        out = [head, "─" * len(head)]
+        with self._lock:
+            for ep, r in sorted(self.ep.items()):
+                lat = sorted(r["lat"])
+                pct = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))] if lat else 0.0
+                st  = " ".join(f"{k}:{v}" for k, v in sorted(r["status"].items()))
+                out.append(f"{ep:<8}{r['n']:>7}{pct(.5):>7.2f}s{pct(.99):>7.2f}s"
+                           f"{(lat[-1] if lat else 0):>7.2f}s{r['wait']:>8.1f}s"
+                           f"{r['bytes_in'] / 1e6:>9.1f}{r['bytes_out'] / 1e6:>8.1f}"
+                           f"{r['retries']:>6}{r['refreshes']:>5}{r['hits']:>6}  {st}")
+        return "\n".join(out)
+
+    def prometheus(self, path: pathlib.Path):
+        """Write a node_exporter textfile (temp file + rename)."""
+        L = ["# TYPE efactura_request_seconds histogram"]
+        with self._lock:
+            for ep, r in sorted(self.ep.items()):
+                acc = 0
+                for b, c in zip(self.BUCKETS, r["hist"]):
+                    acc += c
+                    le = "+Inf" if b == float("inf") else b
+                    L.append(f'efactura_request_seconds_bucket{{ep="{ep}",le="{le}"}} {acc}')
+                L.append(f'efactura_request_seconds_sum{{ep="{ep}"}} {sum(r["lat"]):.4f}')
+                L.append(f'efactura_request_seconds_count{{ep="{ep}"}} {r["n"]}')
+            for name, key in (("limiter_wait_seconds_total", "wait"),
+                              ("bytes_received_total", "bytes_in"),
+                              ("bytes_sent_total", "bytes_out"),
+                              ("retries_total", "retries"),
+                              ("token_refreshes_total", "refreshes"),
+                              ("cache_hits_total", "hits")):
+                L.append(f"# TYPE efactura_{name} counter")
+                L += [f'efactura_{name}{{ep="{ep}"}} {r[key]}' for ep, r in sorted(self.ep.items())]
+            L.append("# TYPE efactura_responses_total counter")
+            L += [f'efactura_responses_total{{ep="{ep}",status="{st}"}} {n}'
+                  for ep, r in sorted(self.ep.items()) for st, n in sorted(r["status"].items())]
+        tmp = path.with_name(f".{path.name}.part")
+        tmp.write_text("\n".join(L) + "\n")
+        os.replace(tmp, path)
+
+    def close(self):
+        with self._lock:
+            if self._log:
+                self._log.close()
+                self._log = None
+
+
+_METRICS = Metrics()
+
+# ────────────────── tracing ─────────────────────────────────────────────
+
+class Tracer:
+    """Timed spans in Chrome trace-event format (Perfetto, chrome://tracing,
+    speedscope).
+
+    • spans nest per thread and inherit their parent's tags, so a rate-limit
+      wait inside ``descarca`` carries that message's ``cui`` / ``mid``
+    • with *profile*: cProfile on every thread (merged into ``FILE.prof``),
+      tracemalloc memory counters in the trace and the top allocation
+      sites in ``FILE.mem.txt``
+    """
+
+    def __init__(self, path: pathlib.Path, profile: bool = False):
+        self.path, self.profile = path, profile
+        self.ev: list[dict] = []
+        self._lock, self._tls = threading.Lock(), threading.local()
+        self._t0, self._pid = time.perf_counter(), os.getpid()
+        self._names: dict[int, str] = {}
+        self._profs: list = []
+        self._stop = threading.Event()
+        if profile:
+            self._start_profile()
+
+    def _emit(self, ev: dict):
+        th = threading.current_thread()
+        ev.update(pid=self._pid, tid=th.ident)
+        with self._lock:
+            self.ev.append(ev)
+            self._names.setdefault(th.ident, th.name)
+
+    def complete(self, name: str, t: float, dur: float, **args):
+        """Record a span that started at ``perf_counter()`` *t*."""
+        args = {**getattr(self._tls, "ctx", {}), **args}
+        self._emit({"name": name, "ph": "X", "ts": (t - self._t0) * 1e6,
+                    "dur": dur * 1e6, "args": args})
+
+    @contextlib.contextmanager
+    def span(self, name: str, **tags):
+        """Time the block; the yielded dict can take more tags."""
+        outer = getattr(self._tls, "ctx", {})
+        ctx = self._tls.ctx = {**outer, **{k: v for k, v in tags.items() if v is not None}}
+        t = time.perf_counter()
+        try:
+            yield ctx
+        finally:
+            self._tls.ctx = outer
+            self._emit({"name": name, "ph": "X", "ts": (t - self._t0) * 1e6,
+                        "dur": (time.perf_counter() - t) * 1e6, "args": ctx})
+
+    def counter(self, name: str, **values):
+        self._emit({"name": name, "ph": "C",
+                    "ts": (time.perf_counter() - self._t0) * 1e6, "args": values})
+
+    def _start_profile(self):
+        import cProfile, tracemalloc
+
+        def _thread(*_):                # first event of every new thread
+            sys.setprofile(None)
+            p = cProfile.Profile()
+            with self._lock:
+                self._profs.append(p)
+            p.enable()
+
+        def _sample():
+            while not self._stop.wait(0.25):
+                cur, peak = tracemalloc.get_traced_memory()
+                self.counter("memory", traced_mb=round(cur / 2**20, 2),
+                             peak_mb=round(peak / 2**20, 2))
+
+        tracemalloc.start(10)
+        threading.setprofile(_thread)
+        self._main = cProfile.Profile()
+        self._main.enable()
+        threading.Thread(target=_sample, name="trace-mem", daemon=True).start()
+
+    def _save_profile(self):
+        import pstats, tracemalloc
+
+        self._main.disable()
+        threading.setprofile(None)
+        self._stop.set()
+        stats = pstats.Stats(self._main)
+        for p in self._profs:
+            p.disable()
+            stats.add(p)
+        stats.dump_stats(f"{self.path}.prof")
+        top = tracemalloc.take_snapshot().statistics("traceback")[:25]
+        tracemalloc.stop()
+        with open(f"{self.path}.mem.txt", "w", encoding="utf-8") as f:
+            for st in top:
+                f.write(f"{st.size / 2**10:.1f} KiB in {st.count} blocks\n")
+                f.write("".join(f"    {ln}\n" for ln in st.traceback.format()))
+        print(f"• profile → {self.path}.prof, allocations → {self.path}.mem.txt")
+
+    def save(self):
+        """Write the trace (temp file + rename)."""
+        if self.profile:
+            self._save_profile()
+        with self._lock:
+            ev = [{"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid,
+                   "args": {"name": name}} for tid, name in self._names.items()] + self.ev
+        tmp = self.path.with_name(f".{self.path.name}.part")
+        tmp.write_text(json.dumps({"traceEvents": ev, "displayTimeUnit": "ms"}))
+        os.replace(tmp, self.path)
+        print(f"• trace → {self.path} ({len(ev)} events)")
+
+
+_TRACE: Tracer | None = None
+
+
+def _span(name: str, **tags):
+    """``_TRACE.span`` when tracing, else a no-op context."""
+    return _TRACE.span(name, **tags) if _TRACE else contextlib.nullcontext({})
 
 
 def _req(m, u, **k):
-    _rate()
-    return requests.request(m, u, **k)
+    ep, waits = _endpoint(u), []
+    body = k.get("data")
+    t0 = time.perf_counter()
+    try:
+        with _span("http", ep=ep) as sp:
+            r = _HTTP.request(m, u, pace=lambda: waits.append(_rate(ep)),
+                              feedback=lambda st, ra: _LIMIT.feedback(ep, st, ra), **k)
+            sp["status"] = r.status_code
+    except Exception as exc:
+        w = sum(waits)
+        _METRICS.observe(ep, type(exc).__name__, time.perf_counter() - t0 - w, w,
+                         retries=max(len(waits) - 1, 0))
+        raise
+    w = sum(waits)
+    _METRICS.observe(ep, r.status_code, time.perf_counter() - t0 - w, w,
+                     0 if k.get("stream") else len(r.content),
+                     len(body) if isinstance(body, (bytes, str)) else 0,
+                     max(len(waits) - 1, 0))
+    return r
 
 _get  = lambda u, **k: _req("GET",  u, **k)
 _post = lambda u, **k: _req("POST", u, **k)
@@ -69,20 +651,6 @@ _env  = lambda: {"TUNNEL_ORIGIN_CERT": str(CERT), **os.environ}
 
 # ────────────────── misc helpers ─────────────────────────────────────────
 
-def _tid_from_token(tok: str) -> str | None:
-    """Extract TunnelID from cloudflared run-token in any format."""
-    try:
-        if tok.lstrip().startswith("{"):
-            obj = json.loads(tok)
-        else:
-            b64 = tok.split(".")[1] if tok.count(".") == 2 else tok
-            b64 += "=" * (-len(b64) % 4)
-            obj = json.loads(base64.b64decode(b64))
-        return obj.get("TunnelID") or obj.get("t")
-    except Exception:
-        return None
-
-
 def _ensure_dict(x: object) -> dict:
     """
     ANAF sometimes returns strings instead of dict.
@@ -97,7 +665,7 @@ def _ensure_dict(x: object) -> dict:
     if isinstance(x, (bytes, bytearray)):
         x = x.decode(errors="ignore")
     try:
-        return json.loads(x)           # succeeds for valid JSON text
+        return _loads(x)               # succeeds for valid JSON text
     except Exception:
         return {"_raw": str(x)}        # keep raw for debugging
 
@@ -134,67 +702,139 @@ def _extract_id(msg: dict | str) -> str | None:
     m = _id_regex.search(raw)
     return m.group(1) if m else None
 
-# ────────────────── bootstrap cloudflared & cert ─────────────────────────
-if not CF_EXE.exists():
-    print("• downloading cloudflared.exe …")
-    urllib.request.urlretrieve(
-        "https://github.com/cloudflare/cloudflared/releases/latest/download/cloudflared-windows-amd64.exe",
-        CF_EXE,
-    )
-
-if not CERT.exists():
-    home_cert = pathlib.Path.home() / ".cloudflared" / "cert.pem"
-    if home_cert.exists():
-        shutil.copy2(home_cert, CERT)
-    else:
-        subprocess.check_call(
-            [CF_EXE, "tunnel", "login", "--origincert", str(CERT)], env=_env()
-        )
-
-subprocess.run([CF_EXE, "tunnel", "create", TUN_NAME],
-               env=_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-# ────────────────── pick connector creds ─────────────────────────────────
-if CRED_JSON.exists():
-    mode, cred = "json", CRED_JSON
-elif TOK_FILE.exists():
-    mode, cred = "token", TOK_FILE.read_text().strip()
-else:
-    print("• requesting new tunnel token")
-    cred = subprocess.check_output([CF_EXE, "tunnel", "token", TUN_NAME],
-                                   env=_env(), text=True).strip()
-    TOK_FILE.write_text(cred)
-    mode = "token"
-    print("  saved → efactura.token")
-
-# map hostname → tunnel (idempotent)
-if mode == "token":
-    tid = _tid_from_token(cred) or sys.exit("✖ Cannot parse TunnelID from token")
-    subprocess.run([CF_EXE, "tunnel", "route", "dns", "--overwrite-dns",
-                    tid, HOST], env=_env(),
-                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-else:
-    subprocess.run([CF_EXE, "tunnel", "route", "dns", "--overwrite-dns",
-                    TUN_NAME, HOST], env=_env(),
-                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+def _when(dc: str | None) -> datetime | None:
+    """Parse ANAF ``data_creare`` (``YYYYMMDDHHMM`` or ISO-like) as local time."""
+    if dc and len(dc) == 12 and dc.isdigit():          # the usual shape
+        try:
+            return datetime(int(dc[:4]), int(dc[4:6]), int(dc[6:8]),
+                            int(dc[8:10]), int(dc[10:]))
+        except ValueError:
+            return None
+    digits = re.sub(r"\D", "", dc or "")[:12]
+    try:
+        return datetime.strptime(digits.ljust(12, "0"), "%Y%m%d%H%M") \
+            if len(digits) >= 8 else None
+    except ValueError:
+        return None
+
+
+def _newer(t: datetime | None, mid: str | None,
+           mark: tuple[datetime | None, str]) -> bool:
+    """True if a message created at *t* is past the (parsed) high-water *mark*."""
+    mt = mark[0]
+    if t is None or mt is None:
+        return True                     # can't tell – let the manifest decide
+    return t > mt or (t == mt and mid != mark[1])
+
+
+def _window(mark: tuple[str, str], cap: int = 60) -> int:
+    """Smallest ``zile`` that reaches back to the calendar day of *mark*."""
+    mt = _when(mark[0])
+    if mt is None:
+        return cap
+    return max(1, min(cap, (datetime.now().date() - mt.date()).days + 1))
+
+# ────────────────── message records ─────────────────────────────────────
+
+@dataclass(slots=True)
+class Msg:
+    """One listing entry, normalised once: what the later stages need and
+    nothing else (the raw dict and its JSON are dropped)."""
+    id: str | None
+    cif: str | None
+    tip: str | None
+    date: str | None                    # data_creare as sent by ANAF
+    detalii: str | None
+    when: datetime | None               # *date* parsed
+    slot: str                           # Primite / Trimise / Erori
+    rel: str                            # folder below DEST
+
+    def row(self) -> dict:
+        """ANAF-shaped dict for the checkpoint table (``_record`` reads it back)."""
+        return {"id": self.id, "cif": self.cif, "tip": self.tip,
+                "data_creare": self.date, "detalii": self.detalii}
+
+
+def _folder(cui: str, tip: str | None, dc: str | None, mid: str | None):
+    slot = TIP2DIR.get(tip, "Erori")
+
+    day  = (dc or "")[:10] or datetime.now(timezone.utc).date().isoformat()
+
+    # ── year / month tree ──────────────────────────────────────────────
+    year  = day[:4]
+    month = day[5:7] if len(day) >= 7 else "NA"        # 01 … 12
+
+    return slot, f"{year}/{cui}/{slot}/{month}/{day}_{mid or 'NA'}"
+
+
+def _record(x: object, cui: str) -> Msg | None:
+    """Raw listing entry → :class:`Msg` in one pass over its keys.
+
+    • the id follows ``_extract_id``: first non-empty ``*id*`` key, and only
+      if there is none the ``detalii`` JSON / regex fallbacks
+    • ``None`` for empty entries
+    """
+    d = x if isinstance(x, dict) else _ensure_dict(x)
+    if not d:
+        return None
+    mid = cif = tip = dc = det = None
+    for k, v in d.items():
+        if k == "tip":
+            tip = v
+        elif k == "data_creare":
+            dc = v
+        elif k == "cif":
+            cif = v
+        elif k == "detalii":
+            det = v
+        if mid is None and v not in (None, "", 0) and "id" in k.lower():
+            mid = str(v)
+    if mid is None:
+        mid = _extract_id(d)
+    return Msg(mid, cif, tip, dc, det, _when(dc), *_folder(cui, tip, dc, mid))
+
+# ────────────────── bootstrap cloudflared & cert (lazy) ──────────────────
+_boot: tuple[str, object] | None = None
+_boot_lock = threading.Lock()
+
+
+def _bootstrap() -> tuple[str, object]:
+    """Prepare cloudflared for the OAuth callback tunnel, once per process.
+
+    Only ``get_jwt()`` needs this, and only when there is no usable token –
+    importing the module or running with a valid tokens.json never spawns
+    cloudflared.  Returns ``(mode, cred)`` for the connector; the work is
+    ``tunnel.prepare()``, so the bootstrap.json memo applies here too.
+    """
+    from tunnel import prepare                 # same steps as `tunnel.py start`
+
+    global _boot
+    with _boot_lock:
+        if _boot is None:
+            _boot = prepare()
+        return _boot
 
 # ────────────────── connector launcher ───────────────────────────────────
 
-def _run_connector(cmd):
+def _run_connector(cmd, timeout=READY_TIMEOUT):
+    """Start the connector and return once it has an edge connection."""
+    from tunnel import ConnectorWatch          # shares the readiness rules
+
     cmd = [str(c) for c in cmd]
     proc = subprocess.Popen(cmd, env=_env(),
                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                            text=True)
-    for _ in range(20):            # 10 s grace
-        if proc.poll() is not None:
-            out, _ = proc.communicate()
-            sys.exit(textwrap.dedent(f"""
-                ✖ tunnel connector failed.
-
-                {' '.join(cmd)}
-                {out or '(no output)'}
-            """))
-        time.sleep(0.5)
+                            text=True, errors="replace", bufsize=1)
+    watch = ConnectorWatch(proc, proc.stdout)   # keeps draining the pipe
+    if not watch.wait(timeout):
+        if proc.poll() is None:
+            proc.terminate()
+        out = "\n".join(watch.tail)
+        sys.exit(textwrap.dedent(f"""
+            ✖ tunnel connector failed: {watch.error}
+
+            {' '.join(cmd)}
+            {out or '(no output)'}
+        """))
     return proc
 
 # ────────────────── tiny callback server ────────────────────────────────
@@ -221,30 +861,122 @@ def _serve():
 
 # ────────────────── JWT helpers ─────────────────────────────────────────
 
+class TokenStore:
+    """In-memory JWT cache backed by tokens.json.
+
+    • ``get()`` never touches the disk after the first load
+    • ``refresh(stale)`` is single-flight: the first caller refreshes, the
+      others wait on the lock and get the new token instead of refreshing
+      again with the one they already know is stale
+    • before refreshing it re-reads tokens.json if the file changed, so a
+      token another process already refreshed is reused, not overwritten
+    • ``start()`` refreshes in the background *lead* seconds before expiry,
+      so hot paths don't have to hit a 401 first
+    • writes go to a temp file + ``os.replace``
+    """
+
+    def __init__(self, path: pathlib.Path = JWT_FILE, lead: float = 300):
+        self.path, self.lead = path, lead
+        self._tok: dict | None = None
+        self._loaded = False
+        self._sig: tuple | None = None     # (inode, mtime, size) of what we read
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._th: threading.Thread | None = None
+
+    def _stat(self) -> tuple | None:
+        try:
+            st = self.path.stat()
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _load(self):
+        sig = self._stat()
+        if not self._loaded or sig != self._sig:
+            self._tok = json.loads(self.path.read_text()) if sig else None
+            self._sig, self._loaded = sig, True
+
+    def get(self) -> dict | None:
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return self._tok
+
+    def save(self, j: dict) -> dict:
+        j["expires_at"] = int(time.time()) + int(j.get("expires_in", 3600)) - 60
+        with self._lock:
+            if j != self._tok:
+                tmp = self.path.with_name(f".{self.path.name}.part")
+                tmp.write_text(json.dumps(j, indent=2))
+                os.replace(tmp, self.path)
+                self._sig = self._stat()
+            self._tok, self._loaded = j, True
+            return j
+
+    def refresh(self, stale: dict | None = None) -> dict:
+        with self._lock:
+            self._load()                   # another process may have refreshed
+            cur = self._tok
+            if stale and cur and cur.get("access_token") != stale.get("access_token"):
+                return cur                 # somebody refreshed while we waited
+            return _jwt_refresh((cur or stale)["refresh_token"])
+
+    def start(self):
+        with self._lock:
+            if self._th is None:
+                self._stop.clear()
+                self._th = threading.Thread(target=self._loop, name="jwt-refresh",
+                                            daemon=True)
+                self._th.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            th, self._th = self._th, None
+        if th:
+            th.join()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            tok = self.get() or {}
+            due = tok.get("expires_at", 0) - self.lead - time.time()
+            if due > 0 or not tok.get("refresh_token"):
+                self._stop.wait(min(max(due, 0), 3600) or 3600)
+                continue
+            try:
+                self.refresh(tok)
+            except Exception as exc:
+                print(f"   ! background token refresh failed: {exc}")
+                self._stop.wait(60)
+
+
+_TOKENS = TokenStore()
+
+
 def _jwt_load():
-    return json.loads(JWT_FILE.read_text()) if JWT_FILE.exists() else None
+    return _TOKENS.get()
 
 
 def _jwt_save(j):
-    j["expires_at"] = int(time.time()) + int(j.get("expires_in", 3600)) - 60
-    if _jwt_load() != j:
-        JWT_FILE.write_text(json.dumps(j, indent=2))
+    return _TOKENS.save(j)
 
 
 def _jwt_refresh(rf):
     payload = {"grant_type": "refresh_token",
                "refresh_token": rf,
                "token_content_type": "jwt"}
-    r = _post(TOKEN_URL, auth=(CID, CSEC),
-              data=payload,
-              headers={"Content-Type": "application/x-www-form-urlencoded"},
-              timeout=TIMEOUT)
+    with _span("_jwt_refresh"):
+        r = _post(TOKEN_URL, auth=(CID, CSEC),
+                  data=payload,
+                  headers={"Content-Type": "application/x-www-form-urlencoded"},
+                  timeout=TIMEOUT)
     r.raise_for_status()
+    _METRICS.add("TOKEN", refreshes=1)
     j = r.json()
     if "refresh_token" not in j:
         j["refresh_token"] = rf
-    _jwt_save(j)
-    return j
+    return _jwt_save(j)
 
 # ────────────────── interactive OAuth (with retry) ──────────────────────
 
@@ -253,8 +985,9 @@ def get_jwt(force_login=False, dbg=False):
     if j and j.get("expires_at", 0) > time.time():
         return j
     if j and j.get("refresh_token"):
-        return _jwt_refresh(j["refresh_token"])
+        return _TOKENS.refresh(j)
 
+    mode, cred = _bootstrap()
     cmd = [CF_EXE, "tunnel", "run", "--url", f"http://127.0.0.1:{PORT}"]
     if mode == "json":
         cmd += [TUN_NAME, "--cred-file", CRED_JSON]
@@ -285,7 +1018,7 @@ def get_jwt(force_login=False, dbg=False):
                    "token_content_type": "jwt"}
         r = _post(TOKEN_URL, auth=(CID, CSEC), data=payload,
                   headers={"Content-Type": "application/x-www-form-urlencoded"},
-                  timeout=TIMEOUT)
+                  timeout=TIMEOUT, retries=0)     # auth codes are single-use
 
         if r.status_code == 500:
             print("⚠️  ANAF returned 500 – trying again …")
@@ -303,138 +1036,1619 @@ def get_jwt(force_login=False, dbg=False):
     srv.shutdown(); proc.terminate()
     sys.exit("✖ OAuth failed three times.")
 
+# ────────────────── download manifest ───────────────────────────────────
+
+class Manifest:
+    """SQLite index of downloaded messages, keyed by ANAF message id.
+
+    Status is ``pending`` while a download is under way and ``ok`` once
+    every file of the message is in place; ``pending``, ``failed``,
+    ``broken`` and ``rejected`` ids are retried on the next run.  Ids already ``ok`` are
+    held in a set so ``main()`` can skip them without touching the disk.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS msg (
+            id TEXT PRIMARY KEY, cui TEXT, tip TEXT, data_creare TEXT,
+            path TEXT, size INTEGER, sha256 TEXT, status TEXT, updated REAL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS mark (
+            cui TEXT PRIMARY KEY, data_creare TEXT, id TEXT, updated REAL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS file (
+            path TEXT PRIMARY KEY, id TEXT, size INTEGER, sha256 TEXT)""")
+        self._lock = threading.Lock()
+        self.status = dict(self.db.execute("SELECT id, status FROM msg"))
+
+    def done(self, mid: str | None) -> bool:
+        return self.status.get(mid) == "ok"
+
+    def put(self, mid: str, status: str, **row):
+        row = {"id": mid, "status": status, "updated": time.time(), **row}
+        cols = ", ".join(row)
+        upd  = ", ".join(f"{k}=excluded.{k}" for k in row if k != "id")
+        with self._lock:
+            self.db.execute(f"INSERT INTO msg ({cols}) VALUES "
+                            f"({', '.join('?' * len(row))}) "
+                            f"ON CONFLICT(id) DO UPDATE SET {upd}",
+                            tuple(row.values()))
+            self.status[mid] = status
+
+    def files(self, mid: str, placed: list[tuple[pathlib.Path, str]]):
+        """Remember size and SHA-256 of every file written for *mid*."""
+        rows = [(str(p), mid, p.stat().st_size, digest) for p, digest in placed]
+        with self._lock, self.db:          # a new copy replaces the old file list
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM file WHERE id=?", (mid,))
+            self.db.executemany("INSERT OR REPLACE INTO file VALUES (?, ?, ?, ?)", rows)
+
+    def mark(self, cui: str) -> tuple[str, str] | None:
+        """High-water mark ``(data_creare, id)`` of *cui*, if any."""
+        with self._lock:
+            return self.db.execute("SELECT data_creare, id FROM mark WHERE cui=?",
+                                   (cui,)).fetchone()
+
+    def unfinished(self, cui: str) -> str | None:
+        """Oldest ``data_creare`` among *cui*'s messages that are not ``ok``."""
+        with self._lock:
+            rows = self.db.execute("SELECT data_creare FROM msg WHERE cui=? "
+                                   "AND status != 'ok'", (cui,)).fetchall()
+        dates = [(t, dc) for (dc,) in rows if (t := _when(dc))]
+        return min(dates)[1] if dates else None
+
+    def set_mark(self, cui: str, data_creare: str, mid: str):
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO mark VALUES (?, ?, ?, ?)",
+                            (cui, data_creare, mid, time.time()))
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+# ────────────────── run checkpoints ─────────────────────────────────────
+
+class Checkpoint:
+    """Work queue of a run, committed to the manifest DB as it progresses.
+
+    A run has one ``job`` per CUI (``pending`` → ``listed`` → ``done``,
+    ``failed`` or ``skipped`` – left to another process) and one ``item`` per message queued for download.  ``--resume``
+    picks up the newest unfinished run: CUIs that were already listed are not
+    listed again, only their unfinished items are retried.
+    """
+
+    def __init__(self, index: Manifest):
+        self.db, self._lock = index.db, index._lock
+        with self._lock:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS run (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, args TEXT,
+                    started REAL, finished REAL);
+                CREATE TABLE IF NOT EXISTS job (
+                    run INTEGER, cui TEXT, state TEXT, error TEXT, listed REAL,
+                    mark_dc TEXT, mark_id TEXT, PRIMARY KEY (run, cui));
+                CREATE TABLE IF NOT EXISTS item (
+                    run INTEGER, cui TEXT, id TEXT, msg TEXT, state TEXT,
+                    PRIMARY KEY (run, id));""")
+
+    def begin(self, cuis: list[str], **args) -> int:
+        with self._lock, self.db:
+            self.db.execute("BEGIN")
+            run = self.db.execute("INSERT INTO run (args, started) VALUES (?, ?)",
+                                  (json.dumps({"cui": cuis, **args}), time.time())).lastrowid
+            self.db.executemany("INSERT INTO job (run, cui, state) VALUES (?, ?, 'pending')",
+                                [(run, c) for c in dict.fromkeys(cuis)])
+        return run
+
+    def last_open(self) -> tuple[int, dict] | None:
+        with self._lock:
+            row = self.db.execute("SELECT id, args FROM run WHERE finished IS NULL "
+                                  "ORDER BY id DESC LIMIT 1").fetchone()
+        return row and (row[0], json.loads(row[1]))
+
+    def jobs(self, run: int) -> dict[str, str]:
+        """Unfinished CUIs of *run* → state."""
+        with self._lock:
+            return dict(self.db.execute("SELECT cui, state FROM job WHERE run=? "
+                                        "AND state != 'done'", (run,)))
+
+    def add(self, run: int, cui: str, items: list[tuple[str, dict]]):
+        """Queue a batch (one listing page) of messages of *cui*."""
+        with self._lock, self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR IGNORE INTO item VALUES (?, ?, ?, ?, 'pending')",
+                                [(run, cui, mid, json.dumps(m)) for mid, m in items])
+
+    def listed(self, run: int, cui: str, mark: tuple[str, str] | None):
+        """*cui* is fully listed; a resume won't list it again."""
+        with self._lock:
+            self.db.execute("UPDATE job SET state='listed', error=NULL, listed=?, "
+                            "mark_dc=?, mark_id=? WHERE run=? AND cui=?",
+                            (time.time(), *(mark or (None, None)), run, cui))
+
+    def items(self, run: int, cui: str) -> tuple[list[tuple[str, dict]], tuple | None] | None:
+        """Unfinished items and stored high-water mark of a CUI, or ``None``
+        if it was never listed in *run*."""
+        with self._lock:
+            job = self.db.execute("SELECT listed, mark_dc, mark_id FROM job "
+                                  "WHERE run=? AND cui=?", (run, cui)).fetchone()
+            if not (job and job[0]):
+                return None
+            rows = self.db.execute("SELECT id, msg FROM item WHERE run=? AND cui=? "
+                                   "AND state != 'done'", (run, cui)).fetchall()
+        return [(mid, json.loads(m)) for mid, m in rows], (job[1:] if job[1] else None)
+
+    def item(self, run: int, mid: str, state: str):
+        with self._lock:
+            self.db.execute("UPDATE item SET state=? WHERE run=? AND id=?", (state, run, mid))
+
+    def job(self, run: int, cui: str, state: str, error: str | None = None):
+        with self._lock:
+            self.db.execute("UPDATE job SET state=?, error=? WHERE run=? AND cui=?",
+                            (state, error, run, cui))
+
+    def finish(self, run: int) -> bool:
+        """Close *run* if every CUI is done; returns whether it was closed."""
+        if self.jobs(run):
+            return False
+        with self._lock:
+            self.db.execute("UPDATE run SET finished=? WHERE id=?", (time.time(), run))
+        return True
+
 # ────────────────── e-Factura API helpers ────────────────────────────────
 
 def lista_mesaje(cui, days, tok, dbg=False):
-    r = _get(LISTA, headers=HDR(tok["access_token"]),
-             params={"cif": cui, "zile": days}, timeout=TIMEOUT)
-    if dbg:
-        print("DEBUG listaMesaje =", r.text)
-    if r.status_code == 401:
-        tok = _jwt_refresh(tok["refresh_token"])
-        r   = _get(LISTA, headers=HDR(tok["access_token"]),
-                   params={"cif": cui, "zile": days}, timeout=TIMEOUT)
-    r.raise_for_status()
+    with _span("lista_mesaje", cui=cui) as sp:
+        r = _get(LISTA, headers=HDR(tok["access_token"]),
+                 params={"cif": cui, "zile": days}, timeout=TIMEOUT)
+        if dbg:
+            print("DEBUG listaMesaje =", r.text)
+        if r.status_code == 401:
+            tok = _TOKENS.refresh(tok)
+            r   = _get(LISTA, headers=HDR(tok["access_token"]),
+                       params={"cif": cui, "zile": days}, timeout=TIMEOUT)
+        r.raise_for_status()
 
-    data = r.json()
-    msgs = data["mesaje"] if isinstance(data, dict) and "mesaje" in data else data
+        data = _loads(r.content)
+        msgs = data["mesaje"] if isinstance(data, dict) and "mesaje" in data else data
+        sp["messages"] = len(msgs) if isinstance(msgs, list) else 0
     return msgs, tok
 
+
+def _lista_pagina(cui, start, end, page, tok):
+    def _ls():
+        return _get(LISTA_PAG, headers=HDR(tok["access_token"]),
+                    params={"cif": cui, "startTime": start, "endTime": end,
+                            "pagina": page}, timeout=TIMEOUT)
+
+    with _span("lista_mesaje", cui=cui, page=page):
+        r = _ls()
+        if r.status_code == 401:
+            tok = _TOKENS.refresh(tok)
+            r   = _ls()
+        r.raise_for_status()
+        return _loads(r.content), tok
+
+
+def lista_mesaje_pag(cui, days, tok, prefetch=True, dbg=False):
+    """Yield the messages of the last *days* for *cui*, one page at a time.
+
+    Uses ``listaMesajePaginatieFactura`` (start/end time in ms + page), so
+    only one page – two with *prefetch*, which fetches the next page while
+    the caller works through the current one – is ever held in memory.
+    Messages come out already passed through ``_ensure_dict``.  An empty
+    interval ends the iteration; any other ``eroare`` raises RuntimeError.
+    """
+    end   = int(time.time() * 1000)
+    start = end - int(days) * 86_400_000
+    fetch = lambda p: _lista_pagina(cui, start, end, p, _TOKENS.get() or tok)
+
+    with ThreadPoolExecutor(1, thread_name_prefix=f"list-{cui}") as ex:
+        page, nxt = 1, ex.submit(fetch, 1)
+        while nxt is not None:
+            data, tok = nxt.result()
+            if dbg:
+                print(f"DEBUG listaMesajePaginatie p{page} =", str(data)[:2000])
+            if not isinstance(data, dict) or "mesaje" not in data:
+                err = str(data.get("eroare") if isinstance(data, dict) else data)
+                if "nu exista mesaje" in err.lower():
+                    return              # {"eroare": "Nu exista mesaje …"}
+                raise RuntimeError(f"ANAF: {err[:300]}")   # wrong CIF, no rights, …
+            pages = int(data.get("numar_total_pagini") or 1)
+            nxt   = ex.submit(fetch, page + 1) if prefetch and page < pages else None
+            for m in data["mesaje"]:
+                if d := _ensure_dict(m):
+                    yield d
+            if nxt is None and page < pages:
+                nxt = ex.submit(fetch, page + 1)
+            page += 1
+
+# ────────────────── content-addressed storage ───────────────────────────
+
+class BlobStore:
+    """Deduplicating file store: ``<root>/<aa>/<sha256>``.
+
+    Downloaded files are hashed while they are written, moved into the store
+    once and hard-linked into the message folders, so an invoice that reaches
+    us through several CUIs (seller and buyer) occupies the disk only once.
+    Falls back to a plain copy where hard links are not supported.
+    """
+
+    def __init__(self, root: pathlib.Path):
+        self.root = root
+        self.hits = self.saved = 0
+        self._lock = threading.Lock()
+
+    def path(self, digest: str) -> pathlib.Path:
+        return self.root / digest[:2] / digest
+
+    def put(self, tmp: pathlib.Path, digest: str) -> pathlib.Path:
+        """Move *tmp* into the store (or drop it if the blob exists)."""
+        blob = self.path(digest)
+        if blob.exists():
+            self._dup(tmp.stat().st_size)
+            tmp.unlink()
+        else:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp, blob)
+        return blob
+
+    def adopt(self, path: pathlib.Path, digest: str) -> bool:
+        """Turn an already-downloaded *path* into a link; False if it is one."""
+        blob = self.path(digest)
+        if blob.exists():
+            if blob.samefile(path):
+                return False
+            self._dup(path.stat().st_size)
+        else:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(path, blob)
+            except OSError:
+                shutil.copy2(path, blob)
+        self.link(blob, path)
+        return True
+
+    def discard_corrupt(self, digest: str) -> bool:
+        """Unlink blob *digest* if its content no longer hashes to its name
+        (links already placed keep the bad data); True if it did."""
+        blob, sha = self.path(digest), hashlib.sha256()
+        try:
+            with open(blob, "rb") as f:
+                while chunk := f.read(CHUNK):
+                    sha.update(chunk)
+        except FileNotFoundError:
+            return False
+        if sha.hexdigest() == digest:
+            return False
+        blob.unlink(missing_ok=True)
+        return True
+
+    def _dup(self, size: int):
+        with self._lock:
+            self.hits += 1
+            self.saved += size
+
+    def link(self, blob: pathlib.Path, out: pathlib.Path):
+        _link(blob, out)
+
+    def place(self, tmp: pathlib.Path, out: pathlib.Path, digest: str):
+        self.link(self.put(tmp, digest), out)
+
+
+def _link(src: pathlib.Path, out: pathlib.Path):
+    """Atomically make *out* a hard link to (or, failing that, a copy of) *src*."""
+    tmp = out.with_name(f".{out.name}.link")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, out)
+
+
+def _place(tmp: pathlib.Path, out: pathlib.Path, digest: str,
+           blobs: BlobStore | None):
+    """Final step for every downloaded file: into the store or just renamed."""
+    if blobs is None:
+        os.replace(tmp, out)
+    else:
+        blobs.place(tmp, out, digest)
+
+
+def _copy_hash(fi, fo) -> str:
+    """copyfileobj that also returns the SHA-256 of what was copied."""
+    sha = hashlib.sha256()
+    while chunk := fi.read(CHUNK):
+        sha.update(chunk)
+        fo.write(chunk)
+    return sha.hexdigest()
+
+# ────────────────── streaming download helpers ──────────────────────────
+
+def _kind(head: bytes) -> str:
+    """Payload type from the first bytes of a download."""
+    if head[:4] == b"PK\x03\x04":
+        return "zip"
+    if head[:5] == b"%PDF-":
+        return "pdf"
+    return "xml" if head.lstrip().startswith(b"<") else "txt"
+
+
+def _member_path(dst: pathlib.Path, name: str) -> pathlib.Path | None:
+    """Target for a ZIP member, with the same sanitising as ``extractall``."""
+    parts = [p for p in pathlib.PurePosixPath(name.replace("\\", "/")).parts
+             if p not in ("", ".", "..", "/") and not p.endswith(":")]
+    return dst.joinpath(*parts) if parts else None
+
+
+def _unzip(src: pathlib.Path, dst: pathlib.Path,
+           blobs: BlobStore | None = None) -> list[tuple[pathlib.Path, str]]:
+    """Extract *src* member by member, each via a temp file + atomic rename.
+    Returns ``(path, sha256)`` of every file written."""
+    placed = []
+    with zipfile.ZipFile(src) as z:
+        for info in z.infolist():
+            out = _member_path(dst, info.filename)
+            if out is None or info.is_dir():
+                continue
+            out.parent.mkdir(parents=True, exist_ok=True)
+            tmp = out.with_name(f".{out.name}.part")
+            try:
+                with z.open(info) as fi, open(tmp, "wb") as fo:
+                    digest = _copy_hash(fi, fo)
+                _place(tmp, out, digest, blobs)
+                placed.append((out, digest))
+            finally:
+                tmp.unlink(missing_ok=True)
+    return placed
+
+
+def _swap(stage: pathlib.Path, dst: pathlib.Path):
+    """Put the finished folder *stage* in place of *dst*.  A crash between
+    the two renames leaves *dst* missing – the id is still ``pending``."""
+    old = dst.with_name(f".{dst.name}.old")
+    if dst.exists():
+        shutil.rmtree(old, ignore_errors=True)
+        os.replace(dst, old)
+    os.replace(stage, dst)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _done(dst: pathlib.Path) -> bool:
+    return any(not p.name.endswith((".part", ".zip.broken")) for p in dst.iterdir())
+
+# ────────────────── packed archive storage ──────────────────────────────
+
+class PackStore:
+    """Messages appended to one ZIP per CUI and month instead of a folder each.
+
+    ``<root>/<year>/<cui>/<year>-<month>.zip`` holds ``<slot>/<month>/<day>_<id>/…``
+    members.  The ``packed`` table in the manifest DB maps every logical
+    name (the path the file would have in the folder tree) to its archive
+    and local-header offset, so ``read()`` seeks straight to it instead of
+    parsing the central directory.
+
+    Each append rewrites the archive's central directory – an interrupted
+    run can leave that stale, but members already indexed stay readable.
+    """
+
+    def __init__(self, root: pathlib.Path, index: Manifest,
+                 coord: Coordinator | None = None):
+        self.root, self.coord = root, coord
+        self.db, self._lock = index.db, index._lock
+        self.spool = root / ".spool"
+        self.spool.mkdir(parents=True, exist_ok=True)
+        self._locks: dict[str, threading.Lock] = {}
+        with self._lock:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS packed (
+                name TEXT PRIMARY KEY, id TEXT, archive TEXT, offset INTEGER,
+                csize INTEGER, size INTEGER, method INTEGER, crc INTEGER)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS packed_id ON packed(id)")
+
+    def archive(self, rel: str) -> str:
+        year, cui, _, month = rel.split("/")[:4]
+        return f"{year}/{cui}/{year}-{month}.zip"
+
+    def put(self, mid: str, dst: pathlib.Path, files):
+        """Append *files* – ``(name, binary file object)`` – of message *mid*
+        whose folder would be *dst*."""
+        rel = dst.relative_to(self.root).as_posix()
+        arc = self.archive(rel)
+        path = self.root / arc
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._locks.setdefault(arc, threading.Lock()):
+            while self.coord and self.coord.lease(f"pack:{arc}"):
+                time.sleep(0.05)                      # another process appends
+            try:
+                rows = []
+                with zipfile.ZipFile(path, "a", zipfile.ZIP_DEFLATED) as z:
+                    for name, fi in files:
+                        zi = zipfile.ZipInfo(f"{rel.split('/', 2)[2]}/{name}",
+                                             time.localtime()[:6])
+                        zi.compress_type = zipfile.ZIP_DEFLATED
+                        with fi, z.open(zi, "w") as fo:
+                            shutil.copyfileobj(fi, fo, CHUNK)
+                        rows.append((f"{rel}/{name}", mid, arc, zi.header_offset,
+                                     zi.compress_size, zi.file_size, zi.compress_type,
+                                     zi.CRC))
+            finally:
+                if self.coord:
+                    self.coord.release(f"pack:{arc}")
+        with self._lock, self.db:           # a new copy replaces all of the old one
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM packed WHERE id=?", (mid,))
+            self.db.executemany("INSERT OR REPLACE INTO packed VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                rows)
+
+    def find(self, mid: str) -> list[str]:
+        """Logical names of everything stored for message *mid*."""
+        with self._lock:
+            return [r[0] for r in self.db.execute(
+                "SELECT name FROM packed WHERE id=? ORDER BY name", (mid,))]
+
+    def read(self, name: str) -> bytes:
+        """Contents of *name*, read from its offset and CRC-checked."""
+        with self._lock:
+            row = self.db.execute("SELECT archive, offset, csize, method, crc FROM packed "
+                                  "WHERE name=?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        arc, offset, csize, method, crc = row
+        with open(self.root / arc, "rb") as f:
+            f.seek(offset)
+            head = f.read(30)
+            if head[:4] != b"PK\x03\x04":
+                raise zipfile.BadZipFile(f"no local header at {arc}:{offset}")
+            f.seek(offset + 30 + sum(struct.unpack("<HH", head[26:30])))
+            data = f.read(csize)
+        if method == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        if zlib.crc32(data) != crc:
+            raise zipfile.BadZipFile(f"CRC mismatch for {name}")
+        return data
+
+    def extract(self, mid: str, out: pathlib.Path) -> list[pathlib.Path]:
+        """Write the files of *mid* into *out* (flat); returns their paths."""
+        out.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for name in self.find(mid):
+            p = out / name.rsplit("/", 1)[1]
+            tmp = p.with_name(f".{p.name}.part")
+            tmp.write_bytes(self.read(name))
+            os.replace(tmp, p)
+            paths.append(p)
+        return paths
+
+
+def _pack(pack: PackStore, mid: str, dst: pathlib.Path, tmp: pathlib.Path, kind: str) -> str:
+    """``descarca``'s storage step for packed mode; returns the kind stored."""
+    if kind == "zip":
+        try:
+            with zipfile.ZipFile(tmp) as z:
+                pack.put(mid, dst, ((out.as_posix(), z.open(info)) for info in z.infolist()
+                                    if not info.is_dir()
+                                    and (out := _member_path(pathlib.Path(), info.filename))))
+            return kind
+        except zipfile.BadZipFile:
+            kind = "zip.broken"
+    with open(tmp, "rb") as fi:
+        pack.put(mid, dst, [(f"{mid}.{kind}", fi)])
+    return kind
+
+
 # ★ PATCH #1 – do not abort on 400/404 for certain message IDs
 # ────────────────── smarter download helper ─────────────────────────────
-def descarca(mid: str | None, dst: pathlib.Path, tok: dict) -> dict:
+def descarca(mid: str | None, dst: pathlib.Path, tok: dict,
+             index: Manifest | None = None, blobs: BlobStore | None = None,
+             pack: PackStore | None = None, **meta) -> dict:
     """Download one message (ZIP / PDF / XML) into *dst*.
 
     • Handles 401 (token refresh) and 400/404 errors gracefully
-    • Detects payload type by magic bytes (ZIP, PDF, XML/TXT)
-    • Skips if the target folder already contains any files
+    • Streams the body to a temp file in CHUNK pieces – memory stays flat
+    • Detects payload type by magic bytes of the first chunk (ZIP, PDF, XML/TXT)
+    • The message is assembled in a ``.<folder>.part`` staging folder that
+      replaces *dst* as a whole – a crash or a bad ZIP member never leaves
+      a half-written *dst* behind
+    • The id is recorded ``pending`` first; a non-empty *dst* counts as
+      downloaded only for ids the manifest has never seen (pre-manifest run)
+    • Records size / SHA-256 / status in *index* (with *meta* columns); a ZIP
+      that won't open is kept as ``<id>.zip.broken`` with status ``broken``
+    • With *blobs*, files are stored once by content and hard-linked here
+    • With *pack*, files are appended to the CUI's monthly archive instead
+      and *dst* is only their logical folder
     """
-    if not mid:
-        print("      ! message without id – skipped")
+    with _span("descarca", cui=meta.get("cui"), mid=mid) as sp:
+        if not mid:
+            print("      ! message without id – skipped")
+            return tok
+
+        if (pack is None and (index is None or mid not in index.status)
+                and dst.is_dir() and _done(dst)):   # already downloaded (pre-manifest run)
+            if index is not None:
+                index.put(mid, "ok", path=str(dst), **meta,
+                          size=sum(p.stat().st_size for p in dst.iterdir()))
+            return tok
+        if index is not None:
+            index.put(mid, "pending", path=str(dst), **meta)
+
+        def _dl():
+            return _get(DESCA,
+                        headers=HDR(tok["access_token"]),
+                        params={"id": mid},
+                        timeout=TIMEOUT, stream=True)
+
+        r = _dl()
+        if r.status_code == 401:
+            r.close()
+            tok = _TOKENS.refresh(tok)
+            r   = _dl()
+
+        with r:
+            if r.status_code in (400, 404):
+                print(f"      ! id {mid} rejected by ANAF ({r.status_code}) – skipping")
+                if index is not None:
+                    index.put(mid, "rejected", path=str(dst), **meta)
+                return tok
+
+            r.raise_for_status()
+            stage = None if pack else dst.with_name(f".{dst.name}.part")
+            if stage:
+                shutil.rmtree(stage, ignore_errors=True)      # left by a crash
+                stage.mkdir(parents=True)
+            tmp, kind = (stage or pack.spool) / f".{mid}.part", None
+            sha, size, placed = hashlib.sha256(), 0, []
+            try:
+                with _span("transfer"), open(tmp, "wb") as fo:
+                    for chunk in r.iter_content(CHUNK):
+                        if kind is None:
+                            kind = _kind(chunk)
+                        sha.update(chunk)
+                        size += len(chunk)
+                        fo.write(chunk)
+                kind = sp["kind"] = kind or "txt"
+                sp["bytes"] = size
+
+                with _span("store"):
+                    if pack is not None:
+                        kind = sp["kind"] = _pack(pack, mid, dst, tmp, kind)
+
+                    # 1) ZIP archive (normal case)
+                    elif kind == "zip":
+                        try:
+                            placed = _unzip(tmp, stage, blobs)
+                        except zipfile.BadZipFile:        # also a member's bad CRC
+                            for p in stage.iterdir():
+                                if p != tmp:
+                                    shutil.rmtree(p) if p.is_dir() else p.unlink()
+                            os.replace(tmp, stage / f"{mid}.zip.broken")
+                            kind = sp["kind"] = "zip.broken"
+                            placed = []
+
+                    # 2) direct PDF (rare buyer-reply messages) / 3) XML or fallback text
+                    else:
+                        out = stage / f"{mid}.{kind}"
+                        _place(tmp, out, sha.hexdigest(), blobs)
+                        placed = [(out, sha.hexdigest())]
+
+                    if stage:
+                        tmp.unlink(missing_ok=True)
+                        _swap(stage, dst)
+                        placed = [(dst / p.relative_to(stage), d) for p, d in placed]
+            finally:
+                tmp.unlink(missing_ok=True)
+                if stage:
+                    shutil.rmtree(stage, ignore_errors=True)
+
+        _METRICS.add("DESCA", bytes_in=size)
+        if kind == "zip.broken":
+            print(f"      ! id {mid}: ANAF sent a broken ZIP – kept as {mid}.zip.broken, "
+                  f"retried next run")
+        if index is not None:
+            index.put(mid, "broken" if kind == "zip.broken" else "ok", path=str(dst),
+                      size=size, sha256=sha.hexdigest(), **meta)
+            index.files(mid, placed)
         return tok
 
-    dst.mkdir(parents=True, exist_ok=True)
-    if any(dst.iterdir()):
-        return tok                     # already downloaded
+def to_pdf(xml, tok, cache=None, std="FACT1", novld="DA"):
+    with _span("to_pdf", mid=xml.parent.name.rpartition("_")[2] or None,
+               file=xml.name) as sp:
+        body = xml.read_bytes()
+        url  = TRANS.format(std=std, novld=novld)
+        pdf  = xml.with_suffix(".pdf")
+        key  = cache and cache.key(body, std, novld)
+        if cache and cache.get(key, pdf):
+            sp["cached"] = True
+            return pdf, tok
+
+        def _tr():
+            return _post(url,
+                         headers={**HDR(tok["access_token"]), "Content-Type": "text/plain"},
+                         data=body, timeout=TIMEOUT)
+
+        r = _tr()
+        if r.status_code == 401:
+            tok = _TOKENS.refresh(tok)
+            r   = _tr()
+        r.raise_for_status()
+        tmp = pdf.with_name(f".{pdf.name}.part")
+        tmp.write_bytes(r.content)
+        os.replace(tmp, pdf)
+        if cache:
+            cache.put(key, pdf)
+        return pdf, tok
 
-    def _dl():
-        return _get(DESCA,
-                    headers=HDR(tok["access_token"]),
-                    params={"id": mid},
-                    timeout=TIMEOUT)
 
-    r = _dl()
-    if r.status_code == 401:
-        tok = _jwt_refresh(tok["refresh_token"])
-        r   = _dl()
+def _pdf_fresh(xml: pathlib.Path) -> bool:
+    """True if the PDF next to *xml* exists and is not older than it."""
+    try:
+        return xml.with_suffix(".pdf").stat().st_mtime >= xml.stat().st_mtime
+    except FileNotFoundError:
+        return False
 
-    if r.status_code in (400, 404):
-        print(f"      ! id {mid} rejected by ANAF ({r.status_code}) – skipping")
-        return tok
 
-    r.raise_for_status()
-    blob = r.content
+class PdfCache:
+    """TRANS results kept on disk by ``sha256(std, novld, XML)``.
+
+    • a repeat conversion – rerun, ``--full`` re-export, the same invoice
+      under another CUI – is hard-linked from ``<root>/<aa>/<key>.pdf``
+    • LRU: a hit bumps the entry's mtime; past *max_bytes* the oldest
+      entries are evicted (links already placed in the tree stay valid)
+    """
+
+    def __init__(self, root: pathlib.Path, max_bytes: int):
+        self.root, self.max = root, max_bytes
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._size = sum(f.stat().st_size for f in root.glob("*/*.pdf")) \
+            if root.exists() else 0
+
+    @staticmethod
+    def key(body: bytes, std: str, novld: str) -> str:
+        return hashlib.sha256(f"{std}/{novld}\n".encode() + body).hexdigest()
 
-    # 1) ZIP archive (normal case)
-    if blob[:4] == b"PK\x03\x04":
+    def path(self, key: str) -> pathlib.Path:
+        return self.root / key[:2] / f"{key}.pdf"
+
+    def get(self, key: str, out: pathlib.Path) -> bool:
+        """Link the cached PDF for *key* to *out*; False on a miss."""
+        src = self.path(key)
         try:
-            with zipfile.ZipFile(io.BytesIO(blob)) as z:
-                z.extractall(dst)
-        except zipfile.BadZipFile:
-            (dst / f"{mid}.zip.broken").write_bytes(blob)
+            os.utime(src)
+            _link(src, out)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        _METRICS.add("TRANS", hits=1)
+        return True
+
+    def put(self, key: str, pdf: pathlib.Path):
+        dst = self.path(key)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        _link(pdf, dst)
+        with self._lock:
+            self._size += dst.stat().st_size
+            if self._size > self.max:
+                self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries down to 90 % of the bound."""
+        files = sorted((st.st_mtime, st.st_size, f) for f in self.root.glob("*/*.pdf")
+                       if (st := f.stat()))
+        self._size = sum(sz for _, sz, _ in files)
+        for _, sz, f in files:
+            if self._size <= self.max * 0.9:
+                break
+            f.unlink(missing_ok=True)
+            self._size -= sz
+
+
+class PdfStage:
+    """XML → PDF conversion on its own worker threads.
+
+    Downloads ``put()`` XML paths into a bounded queue (so a slow TRANS
+    endpoint applies back-pressure instead of piling up memory) and the
+    workers convert them under the TRANS budget of the shared limiter.
+    """
 
-    # 2) direct PDF (rare buyer-reply messages)
-    elif blob[:5] == b"%PDF-":
-        (dst / f"{mid}.pdf").write_bytes(blob)
+    def __init__(self, workers: int = 2, depth: int = 0,
+                 cache: PdfCache | None = None):
+        self.q, self.cache = queue.Queue(depth or workers * 4), cache
+        self.n = {"ok": 0, "skip": 0, "fail": 0}
+        self._lock, self._t0 = threading.Lock(), time.monotonic()
+        self._th = [threading.Thread(target=self._run, name=f"pdf-{i}", daemon=True)
+                    for i in range(max(1, workers))]
+        for t in self._th:
+            t.start()
+
+    def put(self, xml: pathlib.Path, slot: str):
+        self.q.put((xml, slot))
+
+    def _run(self):
+        while (item := self.q.get()) is not None:
+            xml, slot = item
+            try:
+                if _pdf_fresh(xml):
+                    key = "skip"
+                else:
+                    pdf, _ = to_pdf(xml, _TOKENS.get(), self.cache)
+                    print(f"      ↳ {slot:<7} {pdf.name}")
+                    key = "ok"
+            except Exception as exc:
+                print(f"      ! PDF {xml.name}: {exc}")
+                key = "fail"
+            with self._lock:
+                self.n[key] += 1
+
+    def close(self):
+        """Drain the queue, stop the workers and print throughput."""
+        for _ in self._th:
+            self.q.put(None)
+        for t in self._th:
+            t.join()
+        dt = max(time.monotonic() - self._t0, 1e-9)
+        n  = self.n
+        hits = self.cache.hits if self.cache else 0
+        print(f"\n• PDF: {n['ok']} converted ({hits} from cache), {n['skip']} up to date, "
+              f"{n['fail']} failed in {dt:.1f}s ({n['ok'] / dt:.2f}/s)")
+
+# ────────────────── UBL export ──────────────────────────────────────────
+# Leaf paths (local names, below the document root) → invoice column.
+_HEAD = {
+    ("ID",): "number", ("IssueDate",): "issue_date", ("DueDate",): "due_date",
+    ("InvoiceTypeCode",): "type_code", ("CreditNoteTypeCode",): "type_code",
+    ("DocumentCurrencyCode",): "currency",
+    ("AccountingSupplierParty", "Party", "PartyTaxScheme", "CompanyID"): "supplier_cif",
+    ("AccountingSupplierParty", "Party", "PartyLegalEntity", "CompanyID"): "supplier_reg",
+    ("AccountingSupplierParty", "Party", "PartyLegalEntity", "RegistrationName"): "supplier_name",
+    ("AccountingCustomerParty", "Party", "PartyTaxScheme", "CompanyID"): "buyer_cif",
+    ("AccountingCustomerParty", "Party", "PartyLegalEntity", "CompanyID"): "buyer_reg",
+    ("AccountingCustomerParty", "Party", "PartyLegalEntity", "RegistrationName"): "buyer_name",
+    ("TaxTotal", "TaxAmount"): "vat",
+    ("LegalMonetaryTotal", "TaxExclusiveAmount"): "net",
+    ("LegalMonetaryTotal", "TaxInclusiveAmount"): "total",
+    ("LegalMonetaryTotal", "PayableAmount"): "payable",
+}
+# … and below an InvoiceLine / CreditNoteLine → line column.
+_LINE = {
+    ("ID",): "no", ("InvoicedQuantity",): "qty", ("CreditedQuantity",): "qty",
+    ("LineExtensionAmount",): "net", ("Item", "Name"): "name",
+    ("Item", "ClassifiedTaxCategory", "Percent"): "vat_pct",
+    ("Price", "PriceAmount"): "price",
+}
+_INV_COLS = ("path", "mid", "cui", "slot", "doc", "number", "issue_date", "due_date",
+             "type_code", "currency", "supplier_cif", "supplier_name", "buyer_cif",
+             "buyer_name", "net", "vat", "total", "payable", "lines")
+_LINE_COLS = ("path", "no", "name", "qty", "unit", "price", "net", "vat_pct")
+_NUM = {"net", "vat", "total", "payable", "qty", "price", "vat_pct"}
+
+
+def parse_ubl(path: str) -> tuple[dict | None, list[dict]]:
+    """Header and line rows of one UBL invoice / credit note.
+
+    • streams with ``iterparse`` and clears every finished subtree, so memory
+      does not grow with the number of lines
+    • ``(None, [])`` for XML that is not a UBL document (signatures, errors)
+    """
+    head, lines, line, stack = {}, [], None, []
+    for ev, el in ET.iterparse(path, events=("start", "end")):
+        tag = el.tag.rpartition("}")[2]
+        if ev == "start":
+            if not stack:
+                if tag not in ("Invoice", "CreditNote"):
+                    return None, []
+                head["doc"] = tag
+            stack.append(tag)
+            if len(stack) == 2 and tag in ("InvoiceLine", "CreditNoteLine"):
+                line = {}
+            continue
+        key = tuple(stack[1:])
+        if line is not None:
+            col = _LINE.get(key[1:])
+            if col and col not in line:
+                line[col] = el.text
+                if col == "qty":
+                    line["unit"] = el.get("unitCode")
+        else:
+            col = _HEAD.get(key)
+            if col and col not in head:
+                head[col] = el.text
+        stack.pop()
+        if len(stack) == 1:
+            if line is not None:
+                lines.append(line)
+                line = None
+            el.clear()                  # done with this top-level subtree
+    head["supplier_cif"] = head.get("supplier_cif") or head.get("supplier_reg")
+    head["buyer_cif"] = head.get("buyer_cif") or head.get("buyer_reg")
+    for row in (head, *lines):
+        for k in _NUM & row.keys():
+            try:
+                row[k] = float(row[k])
+            except (TypeError, ValueError):
+                row[k] = None
+    return head, lines
+
+
+def _parse_one(path: str):
+    """Process-pool task: ``(path, head, lines, error)``."""
+    try:
+        return (path, *parse_ubl(path), None)
+    except (ET.ParseError, OSError) as exc:
+        return path, None, [], str(exc)
+
+
+class Dataset:
+    """SQLite tables ``invoice`` / ``line`` built from the download tree.
+
+    ``src`` remembers size and mtime of every XML seen, so a rerun only
+    parses files that are new or changed.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS src ("
+                        "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, error TEXT)")
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS invoice ("
+                        f"{', '.join(c + (' TEXT PRIMARY KEY' if c == 'path' else '') for c in _INV_COLS)})")
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS line ({', '.join(_LINE_COLS)})")
+        self.db.execute("CREATE INDEX IF NOT EXISTS line_path ON line(path)")
+
+    def stale(self, files: list[pathlib.Path]) -> list[pathlib.Path]:
+        """The subset of *files* not seen with this size / mtime before."""
+        seen = dict(((p, (s, m)) for p, s, m in
+                     self.db.execute("SELECT path, size, mtime FROM src")))
+        out = []
+        for f in files:
+            st = f.stat()
+            if seen.get(str(f)) != (st.st_size, st.st_mtime):
+                out.append(f)
+        return out
+
+    def put(self, path: str, head: dict | None, lines: list[dict],
+            error: str | None, root: pathlib.Path):
+        st = os.stat(path)
+        self.db.execute("DELETE FROM invoice WHERE path=?", (path,))
+        self.db.execute("DELETE FROM line WHERE path=?", (path,))
+        self.db.execute("INSERT OR REPLACE INTO src VALUES (?, ?, ?, ?)",
+                        (path, st.st_size, st.st_mtime, error))
+        if head is None:
+            return
+        parts = pathlib.Path(path).relative_to(root).parts   # Y/cui/slot/M/day_mid/f
+        # the XML is named after the upload index, the folder after the message
+        mid = parts[4].rpartition("_")[2] if len(parts) > 4 else pathlib.Path(path).stem
+        head.update(path=path, mid=mid, lines=len(lines),
+                    cui=parts[1] if len(parts) > 4 else None,
+                    slot=parts[2] if len(parts) > 4 else None)
+        self.db.execute(f"INSERT INTO invoice VALUES ({', '.join('?' * len(_INV_COLS))})",
+                        [head.get(c) for c in _INV_COLS])
+        self.db.executemany(f"INSERT INTO line VALUES ({', '.join('?' * len(_LINE_COLS))})",
+                            [[path, *(ln.get(c) for c in _LINE_COLS[1:])] for ln in lines])
+
+    def to_csv(self, out: pathlib.Path):
+        out.mkdir(parents=True, exist_ok=True)
+        for table, cols in (("invoice", _INV_COLS), ("line", _LINE_COLS)):
+            tmp = out / f".{table}.csv.part"
+            with open(tmp, "w", newline="", encoding="utf-8") as f:
+                w = csv.writer(f)
+                w.writerow(cols)
+                w.writerows(self.db.execute(f"SELECT {', '.join(cols)} FROM {table}"))
+            os.replace(tmp, out / f"{table}.csv")
+
+    def close(self):
+        self.db.close()
+
+
+def export(root: pathlib.Path, ds: Dataset, workers: int | None = None,
+           full: bool = False) -> dict:
+    """Parse the invoices under *root* into *ds*; returns counters."""
+    files = [f for f in root.rglob("*.xml")
+             if not f.name.startswith(("semnatura_", "."))
+             and not any(p.startswith(".") for p in f.relative_to(root).parts)]
+    todo = files if full else ds.stale(files)
+    n = dict(files=len(files), parsed=0, invoices=0, lines=0, skipped=0, errors=0)
+    if not todo:
+        return n
+    with ProcessPoolExecutor(workers) as ex, ds.db:
+        for i, (path, head, lines, err) in enumerate(
+                ex.map(_parse_one, map(str, todo), chunksize=32), 1):
+            ds.put(path, head, lines, err, root)
+            n["parsed"] += 1
+            n["invoices"] += head is not None
+            n["lines"] += len(lines)
+            n["skipped"] += head is None and err is None
+            n["errors"] += err is not None
+            if err:
+                print(f"   ! {path}: {err}")
+            if i % 1000 == 0:
+                ds.db.commit()
+                print(f"   {i}/{len(todo)} …")
+    return n
+
+# ────────────────── integrity scan ──────────────────────────────────────
+
+def _check(task: tuple[str, str | None]) -> tuple[str, str | None]:
+    """Process-pool task: ``(path, problem)`` for one file.
+
+    • ``.part`` / ``.zip.broken`` leftovers are problems by name
+    • ZIPs (packed archives): every member is read back, CRC-checked;
+      the caller maps failures onto live entries via ``_pack_scan``
+    • XML must be well-formed, PDF must start with ``%PDF-``
+    • *sha* (from the manifest), if known, must match the content
+    """
+    path, sha = task
+    name = os.path.basename(path)
+    try:
+        if name.endswith(".part"):
+            return path, "unfinished download"
+        if name.endswith(".zip.broken"):
+            return path, "ANAF sent a broken ZIP"
+        if name.endswith(".zip"):
+            bad = []
+            with zipfile.ZipFile(path) as z:
+                for info in z.infolist():
+                    try:
+                        with z.open(info) as f:
+                            while f.read(CHUNK):
+                                pass
+                    except (zipfile.BadZipFile, zlib.error):
+                        bad.append(info.filename)
+            return path, bad and f"{len(bad)} bad member(s)"
+        if sha:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                while chunk := f.read(CHUNK):
+                    h.update(chunk)
+            if h.hexdigest() != sha:
+                return path, "content differs from the manifest hash"
+        if name.endswith(".xml"):
+            for _ in ET.iterparse(path):
+                pass
+        elif name.endswith(".pdf"):
+            with open(path, "rb") as f:
+                if f.read(5) != b"%PDF-":
+                    return path, "not a PDF"
+    except (ET.ParseError, zipfile.BadZipFile) as exc:
+        return path, f"{type(exc).__name__}: {exc}"
+    except OSError as exc:
+        return path, str(exc)
+    return path, None
+
+
+def _pack_scan(root: pathlib.Path, index: Manifest, arc: str,
+               read: bool = True) -> list[tuple[str, str]]:
+    """``(member, problem)`` for the indexed members of archive *arc*:
+    ``.zip.broken`` payloads and, with *read*, members that can't be read
+    back via the offset index."""
+    pack = PackStore(root, index)
+    with index._lock:
+        names = [r[0] for r in index.db.execute(
+            "SELECT name FROM packed WHERE archive=?", (arc,))]
+    bad = []
+    for name in names:
+        member = name.split("/", 2)[2]               # as named inside the ZIP
+        if name.endswith(".zip.broken"):
+            bad.append((member, "ANAF sent a broken ZIP"))
+            continue
+        try:
+            if read:
+                pack.read(name)
+        except (OSError, zipfile.BadZipFile, zlib.error):
+            bad.append((member, "corrupt"))
+    return bad
+
+
+def _under(root: pathlib.Path, path: str | None) -> pathlib.Path | None:
+    """Manifest *path* as an absolute path below *root*, else None.  Older
+    runs stored paths relative to their working directory."""
+    p = pathlib.Path(path).expanduser().resolve() if path else None
+    return p if p and p.is_relative_to(root) else None
 
-    # 3) plain XML or fallback text
-    else:
-        name = f"{mid}.xml" if blob.lstrip().startswith(b"<") else f"{mid}.txt"
-        (dst / name).write_bytes(blob)
-
-    return tok
-
-def to_pdf(xml, tok):
-    r = _post(TRANS.format(std="FACT1", novld="DA"),
-              headers={**HDR(tok["access_token"]), "Content-Type": "text/plain"},
-              data=xml.read_bytes(), timeout=TIMEOUT)
-    if r.status_code == 401:
-        tok = _jwt_refresh(tok["refresh_token"])
-        r   = _post(TRANS.format(std="FACT1", novld="DA"),
-                    headers={**HDR(tok["access_token"]), "Content-Type": "text/plain"},
-                    data=xml.read_bytes(), timeout=TIMEOUT)
-    r.raise_for_status()
-    pdf = xml.with_suffix(".pdf")
-    pdf.write_bytes(r.content)
-    return pdf, tok
+
+def verify(root: pathlib.Path, index: Manifest, workers: int | None = None) -> dict:
+    """Scan the tree under *root* in a process pool.
+
+    Returns ``{id: {"problems": [...], "dst": folder}}`` for every message
+    with a bad, unfinished or missing file.
+    """
+    with index._lock:
+        known = {str(f): (mid, sha) for p, mid, sha in
+                 index.db.execute("SELECT path, id, sha256 FROM file")
+                 if (f := _under(root, p))}
+        okay = [(mid, dst) for mid, p in
+                index.db.execute("SELECT id, path FROM msg WHERE status='ok'")
+                if (dst := _under(root, p))]
+        packed = dict(index.db.execute("SELECT DISTINCT id, archive FROM packed")) \
+            if index.db.execute("SELECT 1 FROM sqlite_master WHERE name='packed'").fetchone() \
+            else {}
+    bad: dict[str, dict] = {}
+
+    def _bad(mid, dst, problem):
+        b = bad.setdefault(mid, {"problems": [], "dst": dst})
+        b["problems"].append(problem)
+
+    files = [f for f in root.rglob("*") if f.is_file()
+             and not any(p.startswith(".") for p in f.relative_to(root).parts[:-1])
+             and (not f.name.startswith(".") or f.name.endswith(".part"))]
+    with ProcessPoolExecutor(workers) as ex:
+        tasks = [(str(f), known.get(str(f), (None, None))[1]) for f in files]
+        for path, problem in ex.map(_check, tasks, chunksize=64):
+            f = pathlib.Path(path)
+            if f.name.endswith(".zip") and len(f.relative_to(root).parts) == 3:
+                rel = f.relative_to(root).parent.as_posix()      # <year>/<cui>
+                # only the copies the index points at count – a repaired
+                # message leaves its dead original behind in the archive
+                for m, why in _pack_scan(root, index, f"{rel}/{f.name}", bool(problem)):
+                    folder = pathlib.PurePosixPath(m).parent
+                    _bad(folder.name.rpartition("_")[2], root / rel / folder,
+                         f"{f.name}: {m} {why}")
+                continue
+            if not problem:
+                continue
+            mid = known.get(path, (None,))[0] or f.parent.name.rpartition("_")[2]
+            _bad(mid, f.parent, f"{f.name}: {problem}")
+
+    present = {str(f) for f in files}
+    for p, (mid, _) in known.items():
+        if p not in present:
+            _bad(mid, pathlib.Path(p).parent, f"{pathlib.Path(p).name}: missing")
+    for mid, dst in okay:
+        if mid in packed or mid in bad:
+            continue
+        if not (dst.is_dir() and _done(dst)):
+            _bad(mid, dst, "folder missing or empty")
+    return bad
+
+
+def repair(root: pathlib.Path, index: Manifest, bad: dict, workers: int = 1,
+           coord: Coordinator | None = None, blobs: BlobStore | None = None) -> list[str]:
+    """Re-download every message in *bad* (from ``verify``); returns the ids
+    that failed again.  Folders are moved to ``DEST/.quarantine/<when>/``
+    first; packed messages are simply appended again (the index then points
+    at the new copy).  With *coord* each id is leased like in a normal run."""
+    quarantine = root / ".quarantine" / time.strftime("%Y%m%d-%H%M%S")
+    with index._lock:
+        packed = {r[0] for r in index.db.execute("SELECT DISTINCT id FROM packed")} \
+            if index.db.execute("SELECT 1 FROM sqlite_master WHERE name='packed'").fetchone() \
+            else set()
+    pack = PackStore(root, index, coord) if packed & bad.keys() else None
+    slots = {v: k for k, v in TIP2DIR.items()}
+
+    def _fix(mid, dst):
+        with index._lock:
+            row = index.db.execute("SELECT cui, tip, data_creare FROM msg WHERE id=?",
+                                   (mid,)).fetchone()
+        if row is None:                   # pre-manifest download: ask the path
+            parts = dst.relative_to(root).parts
+            row = (parts[1], slots.get(parts[2]), None) if len(parts) > 2 else (None,) * 3
+        meta = dict(zip(("cui", "tip", "data_creare"), row))
+        if coord and (who := coord.lease(f"msg:{mid}", force=True)):
+            raise RuntimeError(f"taken by {who}")
+        try:
+            if mid in packed:
+                descarca(mid, dst, _TOKENS.get(), index, pack=pack, **meta)
+            else:
+                if dst.exists():
+                    quarantine.mkdir(parents=True, exist_ok=True)
+                    shutil.move(dst, quarantine / f"{dst.name}")
+                if blobs:                 # else the new copy links the bad blob again
+                    with index._lock:
+                        shas = [r[0] for r in index.db.execute(
+                            "SELECT sha256 FROM file WHERE id=?", (mid,))]
+                    for sha in shas:
+                        blobs.discard_corrupt(sha)
+                descarca(mid, dst, _TOKENS.get(), index, blobs, **meta)
+        finally:
+            if coord:
+                coord.release(f"msg:{mid}", done=index.status.get(mid) == "ok")
+        if index.status.get(mid) != "ok":
+            raise RuntimeError(index.status.get(mid) or "not downloaded")
+
+    failed = []
+    with ThreadPoolExecutor(max(1, workers)) as ex:
+        fut = {ex.submit(_fix, mid, b["dst"]): mid for mid, b in bad.items()}
+        for f in fut:
+            try:
+                f.result()
+                print(f"   ✔ {fut[f]}")
+            except Exception as exc:
+                print(f"   ✖ {fut[f]}: {exc}")
+                failed.append(fut[f])
+    return failed
+
+# ────────────────── library API ─────────────────────────────────────────
+
+class Client:
+    """Importable e-Factura client that keeps the current JWT for you::
+
+        from e import Client
+        c = Client()
+        for m in c.mesaje("12345678", 30):
+            c.descarca(_extract_id(m), pathlib.Path("out") / "x")
+    """
+
+    def __init__(self, refresh_ahead: bool = True):
+        get_jwt()
+        if refresh_ahead:
+            _TOKENS.start()
+
+    @property
+    def tok(self) -> dict:
+        return _TOKENS.get()
+
+    def lista_mesaje(self, cui: str, days: int = 60, dbg: bool = False) -> list:
+        return lista_mesaje(cui, days, self.tok, dbg)[0]
+
+    def mesaje(self, cui: str, days: int = 60, prefetch: bool = True):
+        """Lazily yield normalised messages, one listing page at a time."""
+        return lista_mesaje_pag(cui, days, self.tok, prefetch)
+
+    def descarca(self, mid: str | None, dst: pathlib.Path,
+                 index: Manifest | None = None, blobs: BlobStore | None = None,
+                 **meta):
+        descarca(mid, pathlib.Path(dst), self.tok, index, blobs, **meta)
+
+    def to_pdf(self, xml: pathlib.Path, cache: PdfCache | None = None) -> pathlib.Path:
+        return to_pdf(pathlib.Path(xml), self.tok, cache)[0]
+
+    def close(self):
+        _TOKENS.stop()
 
 # ────────────────── CLI main ─────────────────────────────────────────────
 
+def _budget(s: str) -> tuple[str, tuple[float, float]]:
+    """Parse ``NAME=RATE[/BURST]`` (requests per second) for --budget."""
+    name, _, val = s.partition("=")
+    rate, _, burst = val.partition("/")
+    if name.upper() not in ("LISTA", "DESCA", "TRANS") or not rate:
+        raise argparse.ArgumentTypeError(f"bad budget {s!r} (LISTA|DESCA|TRANS=RATE[/BURST])")
+    return name.upper(), (float(rate), float(burst or 1))
+
+
+def dedup_tree(root: pathlib.Path, blobs: BlobStore) -> int:
+    """Move an existing download tree into *blobs*; returns files linked.
+
+    Only message files (``<year>/<cui>/<slot>/<month>/<day>_<id>/…``) are
+    adopted – a database or anything else that is rewritten in place would
+    corrupt the shared blob.
+    """
+    slots, n = {*TIP2DIR.values(), "Erori"}, 0
+    for path in sorted(root.rglob("*")):
+        parts = path.relative_to(root).parts
+        if (not path.is_file() or path.is_symlink() or len(parts) < 6
+                or parts[2] not in slots or any(p.startswith(".") for p in parts)):
+            continue
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK):
+                sha.update(chunk)
+        n += blobs.adopt(path, sha.hexdigest())
+    return n
+
+
+def _cmd_dedup():
+    pa = argparse.ArgumentParser("e.py dedup",
+                                 description="hard-link an existing DEST into DEST/.blobs")
+    pa.add_argument("--dest", default="./efactura")
+    a = pa.parse_args()
+    root = pathlib.Path(a.dest).expanduser()
+    blobs = BlobStore(root / ".blobs")
+    n = dedup_tree(root, blobs)
+    print(f"• {n} file(s) linked, {blobs.hits} duplicate(s), "
+          f"{blobs.saved / 1e6:.1f} MB freed")
+
+
+def _cmd_export():
+    pa = argparse.ArgumentParser("e.py export",
+                                 description="UBL invoices under DEST → SQLite (and CSV)")
+    pa.add_argument("--dest", default="./efactura")
+    pa.add_argument("--db", default=None, help="dataset (default: DEST/.invoices.db)")
+    pa.add_argument("--csv", default=None, metavar="DIR",
+                    help="also write invoice.csv / line.csv into DIR")
+    pa.add_argument("--workers", type=int, default=None,
+                    help="parser processes (default: CPU count)")
+    pa.add_argument("--full", action="store_true",
+                    help="re-parse every file, not only new / changed ones")
+    a = pa.parse_args()
+    root = pathlib.Path(a.dest).expanduser().resolve()
+    ds = Dataset(pathlib.Path(a.db or root / ".invoices.db"))
+    t = time.perf_counter()
+    try:
+        n = export(root, ds, a.workers, a.full)
+        if a.csv:
+            ds.to_csv(pathlib.Path(a.csv))
+    finally:
+        ds.close()
+    print(f"• {n['files']} XML file(s): {n['parsed']} parsed → {n['invoices']} invoice(s), "
+          f"{n['lines']} line(s), {n['skipped']} not UBL, {n['errors']} error(s) "
+          f"in {time.perf_counter() - t:.1f}s")
+
+
+def _cmd_extract():
+    pa = argparse.ArgumentParser("e.py extract",
+                                 description="copy messages out of --store packed archives")
+    pa.add_argument("id", nargs="+", help="ANAF message id(s)")
+    pa.add_argument("--dest", default="./efactura")
+    pa.add_argument("--manifest", default=None,
+                    help="download index (default: DEST/.efactura.db)")
+    pa.add_argument("--out", default=".", help="write the files into OUT/<id>/")
+    pa.add_argument("--list", action="store_true", help="only list what is stored")
+    a = pa.parse_args()
+    root = pathlib.Path(a.dest).expanduser()
+    index = Manifest(pathlib.Path(a.manifest or root / ".efactura.db"))
+    try:
+        pack, missing = PackStore(root, index), 0
+        for mid in a.id:
+            if not (names := pack.find(mid)):
+                print(f"✖ {mid}: not in any archive")
+                missing += 1
+            elif a.list:
+                print("\n".join(names))
+            else:
+                for p in pack.extract(mid, pathlib.Path(a.out) / mid):
+                    print(p)
+    finally:
+        index.close()
+    if missing:
+        sys.exit(1)
+
+
+def _cmd_verify():
+    global _LIMIT
+    pa = argparse.ArgumentParser("e.py verify",
+                                 description="check every file under DEST; --repair "
+                                             "re-downloads the bad messages")
+    pa.add_argument("--dest", default="./efactura")
+    pa.add_argument("--manifest", default=None,
+                    help="download index (default: DEST/.efactura.db)")
+    pa.add_argument("--workers", type=int, default=None,
+                    help="scanner processes (default: CPU count)")
+    pa.add_argument("--repair", action="store_true",
+                    help="quarantine bad messages and download them again")
+    pa.add_argument("--rate", type=float, default=1 / RATE,
+                    help="with --repair: requests per second")
+    pa.add_argument("--repair-workers", type=int, default=1,
+                    help="with --repair: parallel downloads")
+    pa.add_argument("--dedup", action="store_true",
+                    help="with --repair: store files once by SHA-256 (DEST/.blobs)")
+    pa.add_argument("--no-coord", action="store_true",
+                    help="with --repair: don't share the rate limit and leases via coord.db")
+    a = pa.parse_args()
+    root = pathlib.Path(a.dest).expanduser().resolve()
+    index = Manifest(pathlib.Path(a.manifest or root / ".efactura.db"))
+    coord, tokens = None, False
+    try:
+        t = time.perf_counter()
+        bad = verify(root, index, a.workers)
+        for mid, b in sorted(bad.items()):
+            print(f"✖ {mid}: " + "; ".join(b["problems"]))
+        print(f"• {len(bad)} message(s) with problems ({time.perf_counter() - t:.1f}s)")
+        if bad and a.repair:
+            if not (CID and CSEC):
+                sys.exit("Add CLIENT_ID and CLIENT_SECRET to .env")
+            coord = None if a.no_coord else Coordinator(COORD_FILE, str(root))
+            if coord:
+                coord.start()
+            _LIMIT = Limiter(a.rate, shared=coord)
+            # re-packed messages get a second entry of the same name on purpose
+            warnings.filterwarnings("ignore", "Duplicate name", UserWarning)
+            get_jwt()
+            _TOKENS.start()
+            tokens = True
+            print("\n### repair")
+            repair(root, index, bad, a.repair_workers, coord,
+                   BlobStore(root / ".blobs") if a.dedup else None)
+            bad = {m: b for m, b in verify(root, index, a.workers).items() if m in bad}
+            print(f"• {len(bad)} message(s) still bad")
+    finally:
+        if tokens:
+            _TOKENS.stop()
+        if coord:
+            coord.close()
+        index.close()
+    if bad:
+        sys.exit(1)
+
+
+_COMMANDS = {"dedup": _cmd_dedup, "export": _cmd_export, "extract": _cmd_extract,
+             "verify": _cmd_verify}
+
+
 def main():
+    global _LIMIT, _HTTP, _METRICS, _TRACE
+    if len(sys.argv) > 1 and sys.argv[1] in _COMMANDS:
+        return _COMMANDS[sys.argv.pop(1)]()
     pa = argparse.ArgumentParser("Download RO e-Factura")
-    pa.add_argument("--cui", required=True, nargs="+")
+    pa.add_argument("--cui", nargs="+")
     pa.add_argument("--days", type=int, default=60)
     pa.add_argument("--dest", default="./efactura")
     pa.add_argument("--pdf",  action="store_true")
+    pa.add_argument("--pdf-workers", type=int, default=2,
+                    help="parallel XML → PDF conversions")
+    pa.add_argument("--pdf-cache", type=int, default=512, metavar="MB",
+                    help="size bound of the PDF cache in DEST/.pdfcache (0: off)")
+    pa.add_argument("--workers", type=int, default=1,
+                    help="parallel CUI listings / downloads")
+    pa.add_argument("--rate", type=float, default=1 / RATE,
+                    help="sustained requests per second across all endpoints")
+    pa.add_argument("--burst", type=float, default=1,
+                    help="requests that may be sent back-to-back")
+    pa.add_argument("--adaptive", action="store_true",
+                    help="learn per-endpoint rates from ANAF's answers (AIMD), "
+                         "starting from the last run's (rates.json)")
+    pa.add_argument("--max-rate", type=float, default=10,
+                    help="with --adaptive: ceiling per endpoint and overall")
+    pa.add_argument("--budget", type=_budget, action="append", default=[],
+                    metavar="EP=RATE[/BURST]",
+                    help="extra per-endpoint limit, e.g. TRANS=0.2")
+    pa.add_argument("--pool", type=int, default=0,
+                    help="keep-alive connections per host (default: workers, min 4)")
+    pa.add_argument("--retries", type=int, default=3,
+                    help="retries on 5xx / connection reset")
+    pa.add_argument("--manifest", default=None,
+                    help="download index (default: DEST/.efactura.db)")
+    pa.add_argument("--incremental", action="store_true",
+                    help="only fetch messages newer than the last run's mark "
+                         "(and retry older ones that are not ok)")
+    pa.add_argument("--store", choices=("tree", "packed"), default="tree",
+                    help="a folder per message, or one ZIP per CUI and month "
+                         "(read back with 'e.py extract')")
+    pa.add_argument("--dedup", action="store_true",
+                    help="store files once by SHA-256 (DEST/.blobs) and hard-link them")
+    pa.add_argument("--no-paging", action="store_true",
+                    help="use the one-shot listaMesajeFactura instead of pages")
+    pa.add_argument("--coord", default=str(COORD_FILE), metavar="FILE",
+                    help="share the rate limit and split work with other e.py "
+                         "processes through this SQLite file")
+    pa.add_argument("--no-coord", action="store_true",
+                    help="don't coordinate with other processes")
+    pa.add_argument("--resume", action="store_true",
+                    help="continue the last unfinished run instead of starting one")
+    pa.add_argument("--metrics-log", default=None, metavar="FILE",
+                    help="append one JSON line per ANAF request")
+    pa.add_argument("--trace", default=None, metavar="FILE",
+                    help="write a Chrome trace-event JSON of the run's stages")
+    pa.add_argument("--profile", action="store_true",
+                    help="with --trace: also cProfile (FILE.prof) and tracemalloc (FILE.mem.txt)")
+    pa.add_argument("--prom", default=None, metavar="FILE",
+                    help="write a Prometheus textfile with the run's metrics")
     a = pa.parse_args()
+    if not (a.cui or a.resume):
+        pa.error("--cui is required unless --resume is given")
+    if a.store == "packed" and (a.pdf or a.dedup):
+        pa.error("--pdf and --dedup need --store tree")
+    if a.profile and not a.trace:
+        pa.error("--profile needs --trace FILE")
 
     if not (CID and CSEC):
         sys.exit("Add CLIENT_ID and CLIENT_SECRET to .env")
 
-    root = pathlib.Path(a.dest).expanduser()
+    root = pathlib.Path(a.dest).expanduser().resolve()   # manifest paths are absolute
     root.mkdir(parents=True, exist_ok=True)
+    coord = None if a.no_coord else Coordinator(pathlib.Path(a.coord), str(root))
+    if a.adaptive:
+        learned, budgets = _load_rates(), dict(a.budget)
+        _LIMIT = Limiter(a.max_rate, a.burst, shared=coord, adaptive={
+            ep: AdaptiveBucket(learned.get(ep, a.rate), a.burst,
+                               hi=budgets.get(ep, (a.max_rate,))[0])
+            for ep in ("LISTA", "DESCA", "TRANS")})
+    else:
+        _LIMIT = Limiter(a.rate, a.burst, dict(a.budget), shared=coord)
+    _HTTP  = HttpPool(a.pool or max(4, a.workers), a.retries)
+    _METRICS = Metrics(pathlib.Path(a.metrics_log) if a.metrics_log else None)
+    _TRACE = Tracer(pathlib.Path(a.trace), a.profile) if a.trace else None
+    index  = Manifest(pathlib.Path(a.manifest or root / ".efactura.db"))
+    ck     = Checkpoint(index)
+    blobs  = BlobStore(root / ".blobs") if a.dedup else None
+    pack   = PackStore(root, index, coord) if a.store == "packed" else None
+
+    if a.resume:
+        last = ck.last_open()
+        if not last:
+            index.close()
+            sys.exit("✖ nothing to resume")
+        run, args = last
+        a.days = args.get("days", a.days)
+        a.incremental = args.get("incremental", a.incremental)
+        jobs = ck.jobs(run)
+        print(f"• resuming run {run}: {len(jobs)} of {len(args['cui'])} CUI(s) left")
+    else:
+        run  = ck.begin(a.cui, days=a.days, incremental=a.incremental)
+        jobs = dict.fromkeys(a.cui, "pending")
+
+    get_jwt()
+    _TOKENS.start()                   # refresh ahead of expiry from now on
+    if coord:
+        coord.start()                 # keep our leases alive
+    cache = PdfCache(root / ".pdfcache", a.pdf_cache << 20) if a.pdf_cache else None
+    pdfs = PdfStage(a.pdf_workers, cache=cache) if a.pdf else None
+
+    left, lock = {}, threading.Lock()    # per-CUI: [open downloads, error, newest, skipped]
+    failed: dict[str, str] = {}
+    skipped: set[str] = set()
+
+    def _settle(cui, err=None, skip=None):
+        with lock:
+            st = left[cui]
+            st[0] -= 1
+            st[1] = st[1] or err
+            st[3] = st[3] or skip
+            if err:
+                failed[cui] = err
+            if st[0]:
+                return
+            if st[3] and not st[1]:
+                skipped.add(cui)
+        # ids left to another process keep the job open for --resume
+        ck.job(run, cui, "failed" if st[1] else "skipped" if st[3] else "done",
+               st[1] or st[3])
+        if not (st[1] or st[3]) and st[2]:
+            index.set_mark(cui, *st[2])
+        if coord:
+            coord.release(f"cui:{cui}")
+
+    def _one(cui, m):
+        mid, folder = m.id, root / m.rel
+        meta = dict(cui=cui, tip=m.tip, data_creare=m.date)
+        if coord and mid and (who := coord.lease(f"msg:{mid}")):
+            print(f"      · id {mid}: {'already downloaded' if who == 'done' else 'taken by ' + who}")
+            ck.item(run, mid, "done" if who == "done" else "skipped")
+            _settle(cui, skip=who != "done" and f"left to {who}")
+            return
+        try:
+            descarca(mid, folder, _TOKENS.get(), index, blobs, pack, **meta)
+        except Exception as exc:
+            print(f"      ! id {mid} failed: {exc}")
+            if mid:
+                index.put(mid, "failed", path=str(folder), **meta)
+                ck.item(run, mid, "failed")
+                if coord:
+                    coord.release(f"msg:{mid}")
+            _settle(cui, f"download failed: {exc}")
+            return
+        if mid:
+            ck.item(run, mid, "done")
+            if coord:                 # rejected / broken ids stay retryable
+                coord.release(f"msg:{mid}", done=index.status.get(mid) == "ok")
+        _settle(cui)
+        _pdf(folder, m.slot)
+
+    def _pdf(folder, slot):
+        if pdfs and folder.is_dir():
+            for xml in folder.glob("*.xml"):
+                pdfs.put(xml, slot)
+
+    # listing runs on its own threads and blocks here once QUEUED downloads
+    # are outstanding, so downloads start with the first page and only a
+    # bounded number of Msg records is ever held
+    depth = max(1, a.workers) * 4
+    queued = threading.BoundedSemaphore(depth)
+
+    def _submit(cui, batch):
+        with lock:
+            left[cui][0] += len(batch)
+        fut = []
+        for m in batch:
+            queued.acquire()
+            f = pool.submit(_one, cui, m)
+            f.add_done_callback(lambda _: queued.release())
+            fut.append(f)
+        return fut
+
+    def _messages(cui, days):
+        raw = lista_mesaje(cui, days, _TOKENS.get())[0] if a.no_paging \
+            else lista_mesaje_pag(cui, days, _TOKENS.get())
+        return (r for m in raw if (r := _record(m, cui)))
+
+    def _list(cui):
+        """List *cui* page by page, queueing downloads as pages arrive."""
+        days, mark = a.days, a.incremental and index.mark(cui)
+        if mark:
+            days = _window(mark, a.days)
+            if redo := index.unfinished(cui):       # broken / rejected behind the mark
+                days = max(days, _window((redo, ""), a.days))
+        since = f" (since {mark[0]})" if mark else ""
+        print(f"\n### {cui} – last {days} days{since}")
+        mark = mark and (_when(mark[0]), mark[1])
+        fut, new, retry, seen, top, batch = [], 0, 0, 0, None, []
+        for m in _messages(cui, days):
+            mid = m.id
+            st = index.status.get(mid)
+            if mark and not _newer(m.when, mid, mark) and st in (None, "ok"):
+                continue
+            seen += 1
+            key = (m.when, mid or "")
+            if key[0] and (top is None or key > top[0]):
+                top = key, (m.date, mid)
+            if st == "ok":
+                _pdf(root / m.rel, m.slot)     # earlier run: PdfStage skips fresh ones
+                continue
+            new, retry = new + (st is None), retry + (st is not None)
+            batch.append(m)
+            if len(batch) >= depth:              # checkpoint, then queue
+                ck.add(run, cui, [(x.id, x.row()) for x in batch if x.id])
+                fut += _submit(cui, batch)
+                batch = []
+        ck.add(run, cui, [(x.id, x.row()) for x in batch if x.id])
+        fut += _submit(cui, batch)
+        ck.listed(run, cui, top and top[1])
+        with lock:
+            left[cui][2] = top and top[1]
+        print(f"   {cui}: {seen} message(s): {new} new, {retry} retry, "
+              f"{seen - len(fut)} known")
+        return fut
+
+    def _cui(cui):
+        if coord and (who := coord.lease(f"cui:{cui}")):
+            print(f"\n### {cui} – skipped, {who} is on it")
+            ck.job(run, cui, "skipped", f"left to {who}")
+            with lock:
+                skipped.add(cui)
+            return []
+        with lock:
+            left[cui] = [1, None, None, None]
+        fut = []
+        try:
+            if got := a.resume and ck.items(run, cui):
+                todo, top = got
+                with lock:
+                    left[cui][2] = top
+                print(f"\n### {cui} – resumed\n   {len(todo)} message(s) left")
+                fut = _submit(cui, [r for _, x in todo if (r := _record(x, cui))])
+            else:
+                fut = _list(cui)
+        except Exception as exc:
+            print(f"\n### {cui} – ! listing failed: {exc}")
+            _settle(cui, f"listing failed: {exc}")
+            return fut
+        _settle(cui)
+        return fut
 
-    tok = get_jwt()
-
-    for cui in a.cui:
-        print(f"\n### {cui} – last {a.days} days")
-        raw_msgs, tok = lista_mesaje(cui, a.days, tok)
-        msgs = [_ensure_dict(m) for m in raw_msgs if _ensure_dict(m)]
-        print(f"   {len(msgs)} message(s)")
-
-        for m in msgs:
-            mid  = _extract_id(m)
-            slot = TIP2DIR.get(m.get("tip"), "Erori")
-
-            day  = (m.get("data_creare") or "")[:10] \
-                or datetime.now(timezone.utc).date().isoformat()
-
-            # ── NEW: year / month tree ─────────────────────────────────
-            year  = day[:4]
-            month = day[5:7] if len(day) >= 7 else "NA"        # 01 … 12
-
-            folder = root / year / cui / slot / month / f"{day}_{mid or 'NA'}"
-            # ───────────────────────────────────────────────────────────
-
-            tok = descarca(mid, folder, tok)
-
-            if a.pdf:
-                for xml in folder.glob("*.xml"):
-                    try:
-                        pdf, tok = to_pdf(xml, tok)
-                        print(f"      ↳ {slot:<7} {pdf.name}")
-                    except Exception as exc:
-                        print(f"      ! PDF {xml.name}: {exc}")
+    try:
+        with ThreadPoolExecutor(max(1, a.workers)) as pool, \
+                ThreadPoolExecutor(max(1, min(a.workers, len(jobs))),
+                                   thread_name_prefix="list") as lister:
+            pending = {lister.submit(_cui, cui) for cui in jobs}
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        pending.update(f.result() or ())
+            except BaseException:
+                lister.shutdown(cancel_futures=True)
+                pool.shutdown(cancel_futures=True)
+                raise
+        if pdfs:
+            pdfs.close()
+        if blobs:
+            print(f"\n• dedup: {blobs.hits} duplicate file(s), "
+                  f"{blobs.saved / 1e6:.1f} MB not stored twice")
+        if not ck.finish(run):
+            if failed:
+                print(f"\n✖ run {run}: {len(failed)} CUI(s) with failures "
+                      f"({', '.join(failed)}) – rerun with --resume")
+                sys.exit(1)
+            print(f"\n• run {run}: {len(skipped)} CUI(s) left to other processes "
+                  f"({', '.join(sorted(skipped))}) – --resume picks them up")
+    finally:
+        _TOKENS.stop()
+        if coord:
+            coord.close()
+        index.close()
+        if rates := _LIMIT.rates():
+            _save_rates(rates)
+            print("\n• learned rates: " + ", ".join(f"{k} {v:.2f}/s" for k, v in rates.items()))
+        print("\n" + _METRICS.summary())
+        if a.prom:
+            _METRICS.prometheus(pathlib.Path(a.prom))
+        _METRICS.close()
+        if _TRACE:
+            _TRACE.save()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# Tests for e.py: downloads against bench.FakeAnaf, coordination, rate limiting, tokens (run with pytest or unittest)
+import contextlib, io, json, pathlib, shutil, sqlite3, subprocess, sys, tempfile, threading, time, unittest, \
+       zipfile
+from urllib.parse import parse_qs, urlparse
+
+HERE = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE))
+import bench
+import e
+
+
+class CoordinatorTest(unittest.TestCase):
+    """Two processes are simulated by two connections with different owners."""
+
+    def setUp(self):
+        self.tmp = pathlib.Path(tempfile.mkdtemp(prefix="coord-test-"))
+        self.a = self._coord("a:1")
+        self.b = self._coord("b:2")
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _coord(self, owner, scope="/dest", ttl=120):
+        c = e.Coordinator(self.tmp / "coord.db", scope, ttl)
+        c.owner = owner
+        return c
+
+    def test_lease_is_exclusive(self):
+        self.assertIsNone(self.a.lease("cui:1"))
+        self.assertIsNone(self.a.lease("cui:1"))         # re-entrant for the owner
+        self.assertEqual(self.b.lease("cui:1"), "a:1")
+        self.a.release("cui:1")
+        self.assertIsNone(self.b.lease("cui:1"))
+
+    def test_done_marker(self):
+        self.a.lease("msg:7")
+        self.a.release("msg:7", done=True)
+        self.assertEqual(self.b.lease("msg:7"), "done")
+        self.assertIsNone(self.b.lease("msg:7", force=True))
+        self.assertEqual(self.a.lease("msg:7"), "b:2")   # force doesn't steal held leases
+        self.b.release("msg:7")
+        self.assertIsNone(self.a.lease("msg:7"))
+
+    def test_expiry_and_heartbeat(self):
+        short = self._coord("c:3", ttl=0.3)
+        try:
+            self.assertIsNone(short.lease("cui:1"))
+            time.sleep(0.4)                             # no heartbeat: expired
+            self.assertIsNone(self.b.lease("cui:1"))
+            self.b.release("cui:1")
+
+            self.assertIsNone(short.lease("cui:2"))
+            short.start()                               # renews every ttl / 3
+            time.sleep(0.6)
+            self.assertEqual(self.b.lease("cui:2"), "c:3")
+        finally:
+            short.close()
+        self.assertIsNone(self.b.lease("cui:2"))        # close() drops held leases
+
+    def test_scopes_dont_collide(self):
+        other = self._coord("b:2", scope="/elsewhere")
+        try:
+            self.assertIsNone(self.a.lease("cui:1"))
+            self.assertIsNone(other.lease("cui:1"))
+        finally:
+            other.close()
+
+
+class AdaptiveBucketTest(unittest.TestCase):
+
+    def test_additive_increase_within_bounds(self):
+        b = e.AdaptiveBucket(1, hi=2, step=0.5)
+        b.feedback(200)
+        self.assertAlmostEqual(b.rate, 1.5)
+        for _ in range(10):
+            b.feedback(200)
+        self.assertEqual(b.rate, 2)
+
+    def test_429_halves_once_per_episode(self):
+        b = e.AdaptiveBucket(4)
+        b.feedback(429, 0.05)
+        self.assertEqual((b.rate, b.peak), (2, 4))
+        b.feedback(429, 0.05)                  # answer to a request already in flight
+        self.assertEqual(b.rate, 2)
+        self.assertAlmostEqual(b.learned, 3.6)  # just under what drew the 429
+        time.sleep(0.6)                        # quiet period: pause + one interval
+        b.feedback(503)
+        self.assertEqual(b.rate, 1)
+
+    def test_5xx_and_errors_back_off_gently(self):
+        b = e.AdaptiveBucket(5, lo=3)
+        b.feedback(500)
+        self.assertAlmostEqual(b.rate, 4)
+        time.sleep(0.3)
+        b.feedback(None)
+        self.assertAlmostEqual(b.rate, 3.2)
+        time.sleep(0.35)
+        b.feedback(None)
+        self.assertEqual(b.rate, 3)            # floor
+        self.assertIsNone(b.peak)
+
+    def test_retry_after_holds_the_next_slot(self):
+        b = e.AdaptiveBucket(100)
+        b.take()
+        b.feedback(429, 0.3)
+        t = time.monotonic()
+        b.take()
+        self.assertGreater(time.monotonic() - t, 0.25)
+
+    def test_slots_follow_the_rate(self):
+        b = e.AdaptiveBucket(20)
+        t = time.monotonic()
+        for _ in range(5):
+            b.take()
+        self.assertGreater(time.monotonic() - t, 0.15)   # 4 intervals of 50 ms
+
+
+class TokenStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = pathlib.Path(tempfile.mkdtemp(prefix="tokens-test-"))
+        self.path = self.tmp / "tokens.json"
+        self.path.write_text(json.dumps({"access_token": "old", "refresh_token": "r0",
+                                         "expires_at": 0}))
+        self.store = e.TokenStore(self.path)
+        self.calls = []
+        self._refresh, e._jwt_refresh = e._jwt_refresh, self._fake_refresh
+
+    def tearDown(self):
+        e._jwt_refresh = self._refresh
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _fake_refresh(self, rf):
+        self.calls.append(rf)
+        time.sleep(0.2)                        # a slow token endpoint
+        return self.store.save({"access_token": f"new{len(self.calls)}",
+                                "refresh_token": f"r{len(self.calls)}"})
+
+    def test_refresh_is_single_flight(self):
+        stale, got = self.store.get(), []
+        threads = [threading.Thread(target=lambda: got.append(self.store.refresh(stale)))
+                   for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.calls, ["r0"])
+        self.assertEqual({g["access_token"] for g in got}, {"new1"})
+        self.assertEqual(json.loads(self.path.read_text())["access_token"], "new1")
+
+    def test_refresh_after_it_went_stale_again(self):
+        self.store.refresh(self.store.get())
+        self.store.refresh(self.store.get())
+        self.assertEqual(self.calls, ["r0", "r1"])
+
+    def test_refresh_reuses_token_of_another_process(self):
+        stale = self.store.get()
+        other = e.TokenStore(self.path)        # a second e.py on the same file
+        other.save({"access_token": "theirs", "refresh_token": "r9"})
+        self.assertEqual(self.store.refresh(stale)["access_token"], "theirs")
+        self.assertEqual(self.calls, [])
+        self.assertEqual(json.loads(self.path.read_text())["access_token"], "theirs")
+
+    def test_background_refresh_ahead_of_expiry(self):
+        self.store.lead = 3600                 # everything is due
+        self.store.start()
+        try:
+            deadline = time.monotonic() + 5
+            while not self.calls and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            self.store.stop()
+        self.assertEqual(self.calls[:1], ["r0"])
+        self.assertTrue(self.store.get()["access_token"].startswith("new"))
+
+
+def _zip(*members: tuple[str, bytes], bad_crc: int | None = None) -> bytes:
+    """A stored ZIP; with *bad_crc* that member's data is damaged."""
+    b = io.BytesIO()
+    with zipfile.ZipFile(b, "w", zipfile.ZIP_STORED) as z:
+        for name, data in members:
+            z.writestr(name, data)
+    blob = bytearray(b.getvalue())
+    if bad_crc is not None:
+        with zipfile.ZipFile(io.BytesIO(bytes(blob))) as z:
+            info = z.infolist()[bad_crc]
+        blob[info.header_offset + 30 + len(info.filename.encode())] ^= 0xFF
+    return bytes(blob)
+
+
+class FakeAnafCase(unittest.TestCase):
+    """e.py pointed at bench.FakeAnaf; ``payloads[id]`` overrides a download,
+    ids in ``fail`` answer 500."""
+
+    CUIS, MSGS, PAGE, LATENCY = ["10000000"], 6, 500, 0.0
+
+    def setUp(self):
+        self.tmp = pathlib.Path(tempfile.mkdtemp(prefix="efactura-test-"))
+        self.fake = bench.FakeAnaf(self.CUIS, self.MSGS, self.LATENCY,
+                                   page_size=self.PAGE).start()
+        self.payloads: dict[str, tuple[bytes, str]] = {}
+        payload = self.fake.payload
+        self.fake.payload = lambda mid: self.payloads.get(mid) or payload(mid)
+        self.fail: set[str] = set()
+        fail, handler = self.fail, self.fake.srv.RequestHandlerClass
+
+        class Failing(handler):
+            def do_GET(self):
+                if parse_qs(urlparse(self.path).query).get("id", [""])[0] in fail:
+                    return self._send(500, b'{"eroare": "fake"}')
+                super().do_GET()
+        self.fake.srv.RequestHandlerClass = Failing
+        self._saved = e.DESCA, e._LIMIT
+        e.DESCA, e._LIMIT = self.fake.base + "/descarcare", e.Limiter(1000, 100)
+
+    def tearDown(self):
+        e.DESCA, e._LIMIT = self._saved
+        self.fake.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _ids(self, cui: str | None = None) -> list[str]:
+        """Message ids the fake lists for *cui*, oldest first."""
+        return [m.id for m in (e._record(x, c) for c in [cui or self.CUIS[0]]
+                               for x in bench._listing(c, self.MSGS))]
+
+    def _main(self, *args: str) -> tuple[int, str]:
+        """Run e.py's main() in a child process, like ``bench.py run``."""
+        tokens = self.tmp / "tokens.json"
+        tokens.write_text(json.dumps({"access_token": "fake", "refresh_token": "r",
+                                      "expires_at": int(time.time()) + 86400}))
+        argv = ["--dest", str(self.tmp / "out"), "--rate", "1000", "--burst", "100",
+                "--retries", "0", "--no-coord", *args]
+        if "--resume" not in args:
+            argv = ["--cui", *self.CUIS, *argv]
+        code = bench._CHILD.format(here=str(HERE), base=self.fake.base,
+                                   tokens=str(tokens), argv=json.dumps(argv))
+        p = subprocess.run([sys.executable, "-c", code], cwd=self.tmp, text=True,
+                           capture_output=True, timeout=60)
+        return p.returncode, p.stdout + p.stderr
+
+    def _status(self) -> dict[str, str]:
+        with contextlib.closing(sqlite3.connect(self.tmp / "out" / ".efactura.db")) as db:
+            return dict(db.execute("SELECT id, status FROM msg"))
+
+    def _index(self) -> "e.Manifest":
+        index = e.Manifest(self.tmp / "index.db")
+        self.addCleanup(index.close)
+        return index
+
+
+class DescarcaTest(FakeAnafCase):
+
+    def test_bad_member_crc_is_broken_and_retried(self):
+        index, dst = self._index(), self.tmp / "out" / "1_42"
+        body = _zip(("1.xml", b"<Invoice/>"), ("semnatura_1.xml", b"<Signature/>"),
+                    bad_crc=1)
+        self.payloads["42"] = body, "application/zip"
+        with contextlib.redirect_stdout(io.StringIO()):
+            e.descarca("42", dst, {"access_token": "t"}, index)
+        self.assertEqual(index.status["42"], "broken")
+        self.assertEqual(sorted(p.name for p in dst.iterdir()), ["42.zip.broken"])
+
+        # the next run downloads it again instead of trusting the folder
+        del self.payloads["42"]
+        e.descarca("42", dst, {"access_token": "t"}, index)
+        self.assertEqual(self.fake.hits["DESCA"], 2)
+        self.assertEqual(index.status["42"], "ok")
+        self.assertEqual(sorted(p.name for p in dst.iterdir()),
+                         ["42.xml", "semnatura_42.xml"])
+        self.assertEqual(list(dst.parent.iterdir()), [dst])   # no staging left
+
+    def test_interrupted_download_is_pending(self):
+        index, dst = self._index(), self.tmp / "out" / "1_43"
+        unzip = e._unzip
+
+        def crash(src, out, blobs=None):
+            unzip(src, out, blobs)
+            raise KeyboardInterrupt                  # killed mid-store
+        e._unzip = crash
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                e.descarca("43", dst, {"access_token": "t"}, index)
+        finally:
+            e._unzip = unzip
+        self.assertEqual(index.status["43"], "pending")
+        self.assertFalse(dst.exists())
+        e.descarca("43", dst, {"access_token": "t"}, index)
+        self.assertEqual((index.status["43"], self.fake.hits["DESCA"]), ("ok", 2))
+
+    def test_folder_of_unknown_id_counts_as_downloaded(self):
+        index, dst = self._index(), self.tmp / "out" / "1_44"
+        dst.mkdir(parents=True)
+        (dst / "44.xml").write_text("<Invoice/>")
+        e.descarca("44", dst, {"access_token": "t"}, index)
+        self.assertEqual(index.status["44"], "ok")
+        self.assertNotIn("DESCA", self.fake.hits)
+
+
+class IncrementalTest(FakeAnafCase):
+
+    def test_broken_id_behind_the_mark_is_retried(self):
+        newest = self._ids()[-1]                      # becomes the mark
+        self.payloads[newest] = b"PK\x03\x04 truncated", "application/zip"
+        code, out = self._main("--incremental")
+        self.assertEqual(code, 0, out)
+        self.assertEqual(self._status()[newest], "broken")
+
+        del self.payloads[newest]
+        hits = self.fake.hits["DESCA"]
+        code, out = self._main("--incremental")
+        self.assertEqual(code, 0, out)
+        self.assertEqual(self.fake.hits["DESCA"] - hits, 1)
+        self.assertEqual(set(self._status().values()), {"ok"})
+
+        code, out = self._main("--incremental")       # nothing left to do
+        self.assertIn("0 message(s)", out)
+        self.assertEqual(self.fake.hits["DESCA"] - hits, 1)
+
+
+class ResumeTest(FakeAnafCase):
+
+    def test_failed_download_is_resumed(self):
+        bad = self._ids()[2]
+        self.fail.add(bad)
+        code, out = self._main()
+        self.assertEqual(code, 1, out)
+        self.assertIn("rerun with --resume", out)
+        self.assertEqual(self._status()[bad], "failed")
+
+        self.fail.clear()
+        hits = dict(self.fake.hits)
+        code, out = self._main("--resume")
+        self.assertEqual(code, 0, out)
+        self.assertIn("resumed", out)
+        self.assertEqual(self.fake.hits["DESCA"] - hits["DESCA"], 1)
+        self.assertEqual(self.fake.hits["LISTA"], hits["LISTA"])    # not listed again
+        self.assertEqual(set(self._status().values()), {"ok"})
+
+        code, out = self._main("--resume")
+        self.assertIn("nothing to resume", out)
+
+    def test_broken_download_is_retried(self):
+        bad = self._ids()[1]
+        self.payloads[bad] = b"PK\x03\x04 truncated", "application/zip"
+        code, out = self._main()
+        self.assertEqual(code, 0, out)
+        self.assertEqual(self._status()[bad], "broken")
+
+        del self.payloads[bad]
+        hits = self.fake.hits["DESCA"]
+        code, out = self._main()
+        self.assertEqual(code, 0, out)
+        self.assertEqual(self.fake.hits["DESCA"] - hits, 1)
+        self.assertEqual(set(self._status().values()), {"ok"})
+        self.assertEqual(list((self.tmp / "out").rglob("*.broken")), [])
+
+
+class ListingTest(FakeAnafCase):
+
+    MSGS, PAGE, LATENCY = 60, 6, 0.02      # a listing page takes as long as a download
+
+    def test_downloads_start_before_listing_ends(self):
+        log = self.tmp / "requests.jsonl"
+        code, out = self._main("--workers", "1", "--metrics-log", str(log))
+        self.assertEqual(code, 0, out)
+        t = {}
+        for r in map(json.loads, log.read_text().splitlines()):
+            t.setdefault(r["ep"], []).append(r["t"])
+        self.assertEqual((len(t["LISTA"]), len(t["DESCA"])), (10, 60))
+        self.assertLess(min(t["DESCA"]), max(t["LISTA"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# Supervisor tests against a fake connector (POSIX; run with pytest or unittest)
+import json, pathlib, shutil, signal, socket, subprocess, sys, tempfile, textwrap, time, \
+       unittest, urllib.error, urllib.request
+
+HERE = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE))
+import tunnel
+
+# Stands in for `cloudflared tunnel run`: *ready* logs an edge connection and
+# stays up, *crash* logs it and exits 1, *silent* never connects.
+FAKE = textwrap.dedent("""
+    import sys, time
+    mode = sys.argv[1]
+    if mode != "silent":
+        print("INF Registered tunnel connection connIndex=0", flush=True)
+    if mode == "crash":
+        time.sleep(0.2)
+        sys.exit(1)
+    time.sleep(3600)
+""")
+
+# Runs a Supervisor in its own process – run() installs signal handlers,
+# which only the main thread may do.
+CHILD = textwrap.dedent("""
+    import pathlib, sys
+    sys.path.insert(0, {here!r})
+    import tunnel
+    tunnel.PID_FILE = pathlib.Path({pid!r})
+    tunnel.BACKOFF_MAX = 4
+    tunnel.READY_TIMEOUT = {ready}
+    sup = tunnel.Supervisor([sys.executable, {fake!r}, {mode!r}], port={port},
+                            log_file=pathlib.Path({log!r}))
+    sys.exit(0 if sup.run() else 1)
+""")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@unittest.skipIf(tunnel.WINDOWS, "POSIX process layer")
+class SupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = pathlib.Path(tempfile.mkdtemp(prefix="tunnel-test-"))
+        self.fake = self.tmp / "fake_cloudflared.py"
+        self.fake.write_text(FAKE)
+        self.port = _free_port()
+        self.proc = None
+
+    def tearDown(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _start(self, mode, ready=5):
+        code = CHILD.format(here=str(HERE), pid=str(self.tmp / "tunnel.pid"),
+                            fake=str(self.fake), mode=mode, port=self.port,
+                            log=str(self.tmp / "tunnel.log"), ready=ready)
+        self.proc = subprocess.Popen([sys.executable, "-c", code],
+                                     stdout=subprocess.DEVNULL)
+
+    def _get(self, path):
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.port}{path}",
+                                    timeout=1) as r:
+            return r.status, r.read()
+
+    def _status(self):
+        return json.loads(self._get("/status")[1])
+
+    def _until(self, pred, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if st := pred(self._status()):
+                    return st
+            except OSError:
+                pass                              # not serving yet
+            time.sleep(0.05)
+        self.fail(f"condition not met within {timeout}s")
+
+    def test_ready(self):
+        self._start("ready")
+        st = self._until(lambda s: s["state"] == "running" and s)
+        self.assertTrue(st["pid"] and st["connected_at"])
+        self.assertEqual(st["restarts"], 0)
+        self.assertEqual(self._get("/health"), (200, b"ok"))
+        pid = json.loads((self.tmp / "tunnel.pid").read_text())
+        self.assertEqual(pid["pid"], st["pid"])
+
+        self.proc.send_signal(signal.SIGTERM)
+        self.assertEqual(self.proc.wait(15), 0)
+        self.assertFalse((self.tmp / "tunnel.pid").exists())
+        self.assertFalse(tunnel.PROCS.alive(st["pid"]))
+
+    def test_restart_with_backoff(self):
+        self._start("crash")
+        t0 = time.monotonic()
+        self._until(lambda s: s["restarts"] >= 1)
+        first = time.monotonic() - t0
+        st = self._until(lambda s: s["restarts"] >= 3 and s, timeout=20)
+        self.assertEqual(st["last_exit"], 1)
+        # the third exit comes after backoff waits of 1 and 2 s
+        self.assertLess(first, 3)
+        self.assertGreater(time.monotonic() - t0, 3)
+        self.proc.send_signal(signal.SIGTERM)
+        self.assertEqual(self.proc.wait(15), 0)
+
+    def test_status_while_starting(self):
+        self._start("silent", ready=30)
+        st = self._until(lambda s: s["state"] == "starting" and s["pid"] and s)
+        self.assertEqual(self._status()["restarts"], 0)
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self._get("/health")
+        self.assertEqual(cm.exception.code, 503)
+
+        # `tunnel.py status` and CloudflaredService.php count it as up
+        port, tunnel.STATUS_PORT = tunnel.STATUS_PORT, self.port
+        try:
+            self.assertEqual(tunnel.supervisor_status()["pid"], st["pid"])
+            self.assertTrue(tunnel.check_tunnel())
+        finally:
+            tunnel.STATUS_PORT = port
+        self.proc.send_signal(signal.SIGTERM)
+        self.assertEqual(self.proc.wait(15), 0)
+
+    def test_start_defers_to_supervisor_in_backoff(self):
+        self._start("crash")
+        self._until(lambda s: s["state"] == "backoff")
+
+        def prepare(force=False):
+            raise AssertionError("started a second connector")
+        saved = tunnel.PID_FILE, tunnel.prepare
+        tunnel.PID_FILE, tunnel.prepare = self.tmp / "tunnel.pid", prepare
+        try:
+            self.assertTrue(tunnel.start_tunnel())
+        finally:
+            tunnel.PID_FILE, tunnel.prepare = saved
+        self.proc.send_signal(signal.SIGTERM)
+        self.assertEqual(self.proc.wait(15), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 # Cloudflared tunnel management for e-Factura
-import json, os, pathlib, subprocess, sys, time, shutil, urllib.request
+import collections, hashlib, json, os, pathlib, re, signal, subprocess, sys, threading, \
+       time, shutil, urllib.request
+import logging, logging.handlers
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from dotenv import load_dotenv
 
 # Configuration
@@ -9,12 +12,39 @@ ROOT, HOST, TUN_NAME, PORT = (
 )
 
 HERE = pathlib.Path(__file__).resolve().parent
+WINDOWS = os.name == "nt"
 CF_EXE = HERE / "cloudflared.exe"
 CERT = HERE / "cert.pem"
 CRED_JSON = HERE / "efactura.json"
 TOK_FILE = HERE / "efactura.token"
+STATE_FILE = HERE / "bootstrap.json"   # memoized bootstrap (see prepare())
+
+# Supervisor
+PID_FILE = HERE / "tunnel.pid"
+LOG_FILE = HERE / "tunnel.log"
+START_LOG = HERE / "tunnel-start.log"  # connector of `start` (the supervisor owns LOG_FILE)
+LOG_MAX, LOG_KEEP = 5 << 20, 3          # rotate at 5 MB, keep 3 old logs
+STATUS_HOST = "127.0.0.1"
+BACKOFF_MAX = 60                        # seconds between restarts, at most
+UP_STATES = ("running", "starting")     # `status` says running (CloudflaredService.php too)
+
+# Connector readiness
+READY_RE = re.compile(r"Registered tunnel connection|Connection \S+ registered", re.I)
+FATAL_RE = re.compile(
+    r"Unauthorized|token is not valid|Invalid tunnel secret|"
+    r"Cannot determine default origin certificate|"
+    r"tunnel credentials file .*(not found|doesn't exist)|"
+    r"error parsing tunnel ID|failed to parse|flag provided but not defined", re.I)
 
 load_dotenv(HERE / ".env")
+STATUS_PORT = int(os.getenv("TUNNEL_STATUS_PORT", "8766"))
+READY_TIMEOUT = float(os.getenv("TUNNEL_READY_TIMEOUT", "30"))
+
+if not WINDOWS:
+    CF_EXE = pathlib.Path(os.getenv("CLOUDFLARED") or shutil.which("cloudflared")
+                          or HERE / "cloudflared")
+elif os.getenv("CLOUDFLARED"):
+    CF_EXE = pathlib.Path(os.environ["CLOUDFLARED"])
 
 def _env():
     return {"TUNNEL_ORIGIN_CERT": str(CERT), **os.environ}
@@ -33,10 +63,39 @@ def _tid_from_token(tok: str) -> str | None:
     except Exception:
         return None
 
-def bootstrap():
+# Bootstrap state: `tunnel create` and `tunnel route dns` are remote round
+# trips, so they only run when one of their inputs (cert, token, creds,
+# hostname) differs from what bootstrap.json recorded after the last success.
+
+def _fp(path):
+    """Short SHA-256 fingerprint of a file, or None if it doesn't exist."""
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()[:16]
+    except OSError:
+        return None
+
+def _load_state():
+    try:
+        return json.loads(STATE_FILE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+def _save_state(st):
+    tmp = STATE_FILE.with_name(STATE_FILE.name + ".part")
+    tmp.write_text(json.dumps(st, indent=2))
+    os.replace(tmp, STATE_FILE)
+
+def _cf(*args):
+    """Run a cloudflared command; returns (ok, output)."""
+    r = subprocess.run([str(CF_EXE), *args], env=_env(), capture_output=True,
+                       text=True, errors="replace")
+    return r.returncode == 0, (r.stdout + r.stderr).strip()
+
+def bootstrap(force=False):
     """Bootstrap cloudflared executable and certificate."""
-    # Download cloudflared if not exists
-    if not CF_EXE.exists():
+    # Download cloudflared if not exists (Windows build only; on POSIX
+    # install cloudflared from the package manager or set CLOUDFLARED)
+    if WINDOWS and not CF_EXE.exists():
         print("Downloading cloudflared.exe...")
         urllib.request.urlretrieve(
             "https://github.com/cloudflare/cloudflared/releases/latest/download/cloudflared-windows-amd64.exe",
@@ -53,9 +112,14 @@ def bootstrap():
                 [CF_EXE, "tunnel", "login", "--origincert", str(CERT)], env=_env()
             )
 
-    # Create tunnel (idempotent)
-    subprocess.run([CF_EXE, "tunnel", "create", TUN_NAME],
-                   env=_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Create tunnel (idempotent) – only when the cert or tunnel name changed
+    st, cert = _load_state(), _fp(CERT)
+    if force or st.get("cert") != cert or st.get("tunnel") != TUN_NAME:
+        ok, out = _cf("tunnel", "create", TUN_NAME)
+        if ok or "already exists" in out:
+            _save_state({**st, "cert": cert, "tunnel": TUN_NAME})
+        else:
+            print(f"tunnel create failed: {out}")
 
 def get_credentials():
     """Get tunnel credentials (JSON or token)."""
@@ -71,50 +135,83 @@ def get_credentials():
         print("Token saved to efactura.token")
         return "token", cred
 
-def setup_dns(mode, cred):
-    """Setup DNS routing for the tunnel."""
+def setup_dns(mode, cred, force=False):
+    """Setup DNS routing for the tunnel – only when token/creds/host changed."""
+    st = _load_state()
+    want = {"host": HOST, "token": _fp(TOK_FILE) if mode == "token" else None,
+            "creds": _fp(CRED_JSON) if mode == "json" else None}
     if mode == "token":
-        tid = _tid_from_token(cred) or sys.exit("Cannot parse TunnelID from token")
-        subprocess.run([CF_EXE, "tunnel", "route", "dns", "--overwrite-dns",
-                        tid, HOST], env=_env(),
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # the TunnelID parse is cached with the token fingerprint
+        tid = st.get("tunnel_id") if st.get("token") == want["token"] else None
+        tid = tid or _tid_from_token(cred) or sys.exit("Cannot parse TunnelID from token")
+    else:
+        tid = TUN_NAME
+    if not force and all(st.get(k) == v for k, v in want.items()) \
+            and st.get("tunnel_id") == tid:
+        return
+    ok, out = _cf("tunnel", "route", "dns", "--overwrite-dns", tid, HOST)
+    if ok:
+        _save_state({**st, **want, "tunnel_id": tid})
+    else:
+        print(f"DNS route failed: {out}")
+
+def prepare(force=False):
+    """Bootstrap, credentials and DNS; a warm start spawns no cloudflared."""
+    bootstrap(force)
+    mode, cred = get_credentials()
+    setup_dns(mode, cred, force)
+    return mode, cred
+
+def tunnel_cmd(mode, cred):
+    """cloudflared command line for the connector."""
+    # use localhost with Host header for Herd compatibility
+    cmd = [str(CF_EXE), "tunnel", "run", "--url", "http://127.0.0.1:80",
+           "--http-host-header", "u-core.test"]
+    if mode == "json":
+        cmd += [TUN_NAME, "--cred-file", str(CRED_JSON)]
     else:
-        subprocess.run([CF_EXE, "tunnel", "route", "dns", "--overwrite-dns",
-                        TUN_NAME, HOST], env=_env(),
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        cmd += ["--token", cred]
+    return cmd
 
-def start_tunnel():
-    """Start the cloudflared tunnel."""
+def _start_log():
+    """START_LOG opened for appending; rotated once it passed LOG_MAX."""
     try:
-        bootstrap()
-        mode, cred = get_credentials()
-        setup_dns(mode, cred)
-        
-        # Build command - use localhost with Host header for Herd compatibility
-        cmd = [str(CF_EXE), "tunnel", "run", "--url", "http://127.0.0.1:80", 
-               "--http-host-header", "u-core.test"]
-        if mode == "json":
-            cmd += [TUN_NAME, "--cred-file", str(CRED_JSON)]
-        else:
-            cmd += ["--token", cred]
-        
+        if START_LOG.stat().st_size > LOG_MAX:
+            os.replace(START_LOG, START_LOG.with_name(START_LOG.name + ".1"))
+    except OSError:
+        pass                            # missing, or still open on Windows
+    return open(START_LOG, "ab")
+
+def start_tunnel(force=False):
+    """Start the cloudflared tunnel (or leave it to a running supervisor)."""
+    info = _read_pid()
+    if info:
+        # it restarts the connector itself, also while in backoff
+        print(f"Supervisor {info['supervisor']} is managing the tunnel")
+        return True
+    try:
+        mode, cred = prepare(force)
+        cmd = tunnel_cmd(mode, cred)
+
         print(f"Starting tunnel in {mode.upper()} mode...")
         print(f"Command: {' '.join(cmd)}")
-        
-        # Start the process
-        proc = subprocess.Popen(cmd, env=_env(),
-                                stdout=subprocess.PIPE, 
-                                stderr=subprocess.STDOUT,
-                                text=True)
-        
-        # Wait a bit to check if it starts successfully
-        for i in range(10):
-            if proc.poll() is not None:
-                out, _ = proc.communicate()
-                print(f"Tunnel failed to start: {out}")
-                return False
-            time.sleep(0.5)
-        
+
+        # Start the process; output goes to the log file, not to a pipe that
+        # nobody drains once this script exits
+        log = _start_log()
+        offset = log.tell()
+        proc = subprocess.Popen(cmd, env=_env(), stdout=log,
+                                stderr=subprocess.STDOUT, **_detach())
+        log.close()
+
+        # Return as soon as the first edge connection is registered
+        watch = ConnectorWatch(proc, follow(START_LOG, offset, proc))
+        if not watch.wait(READY_TIMEOUT):
+            print(f"Tunnel failed to start: {watch.error}\n" + "\n".join(watch.tail))
+            if proc.poll() is None:
+                proc.terminate()
+            return False
+
         print("Tunnel started successfully")
         return True
         
@@ -122,25 +219,336 @@ def start_tunnel():
         print(f"Error starting tunnel: {e}")
         return False
 
+class ConnectorWatch:
+    """Follows a connector's output and reports when it is connected.
+
+    *lines* is any iterable of output lines (``proc.stdout`` or ``follow()``
+    of a log file); it is drained on a daemon thread for as long as it
+    yields, so a pipe never fills up.  ``wait()`` returns as soon as the
+    first edge connection is registered and fails fast on known fatal error
+    lines, on process exit, or after *timeout* seconds.
+    """
+
+    def __init__(self, proc, lines, sink=None):
+        self.proc, self.sink = proc, sink
+        self.error = None
+        self.tail = collections.deque(maxlen=40)
+        self._ready = threading.Event()
+        self._event = threading.Event()
+        threading.Thread(target=self._run, args=(lines,), daemon=True).start()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def _run(self, lines):
+        for line in lines:
+            line = line.rstrip()
+            self.tail.append(line)
+            if self.sink:
+                self.sink(line)
+            if not self._ready.is_set():
+                if READY_RE.search(line):
+                    self._ready.set()
+                    self._event.set()
+                elif FATAL_RE.search(line):
+                    self.error = line
+                    self._event.set()
+        if not self._ready.is_set():
+            self.error = self.error or f"connector exited with {self.proc.wait()}"
+        self._event.set()
+
+    def wait(self, timeout=READY_TIMEOUT, abort=None):
+        """True once connected; False on error, exit, timeout or *abort*."""
+        deadline = time.monotonic() + timeout
+        while not (self._ready.is_set() or self.error):
+            left = deadline - time.monotonic()
+            if left <= 0 or (abort is not None and abort.is_set()):
+                self.error = self.error or f"not connected after {timeout:.0f}s"
+                break
+            if self.proc.poll() is not None:
+                self._event.wait(1)     # let the reader flush the last lines
+                self.error = self.error or f"connector exited with {self.proc.returncode}"
+                break
+            self._event.wait(min(left, 0.25))
+        return self._ready.is_set()
+
+def follow(path, offset, proc, poll=0.1):
+    """Yield lines appended to *path* after *offset* while *proc* runs."""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        f.seek(offset)
+        buf = ""
+        while True:
+            chunk = f.read()
+            if chunk:
+                buf += chunk
+                *done, buf = buf.split("\n")
+                yield from done
+            elif proc.poll() is not None:
+                if buf:
+                    yield buf
+                return
+            else:
+                time.sleep(poll)
+
+# ────────────────── process management ──────────────────────────────────
+
+class PosixProcs:
+    """Process helpers for Linux / macOS."""
+
+    name = "cloudflared"
+
+    def detach(self):
+        return {"start_new_session": True}
+
+    def alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def terminate(self, pid, grace=10.0):
+        """SIGTERM, then SIGKILL after *grace* seconds."""
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return True
+        deadline = time.monotonic() + grace
+        while time.monotonic() < deadline:
+            if not self.alive(pid):
+                return True
+            time.sleep(0.1)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        return True
+
+    def running(self):
+        r = subprocess.run(["pgrep", "-x", self.name], capture_output=True, text=True)
+        return r.returncode == 0
+
+    def kill_all(self):
+        subprocess.run(["pkill", "-x", self.name], capture_output=True)
+
+
+class WindowsProcs:
+    """Process helpers for Windows (tasklist / taskkill)."""
+
+    name = "cloudflared.exe"
+
+    def detach(self):
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP
+                                 | subprocess.CREATE_NO_WINDOW}
+
+    def alive(self, pid):
+        r = subprocess.run(["tasklist", "/FI", f"PID eq {pid}", "/FO", "CSV", "/NH"],
+                           capture_output=True, text=True)
+        return f'"{pid}"' in r.stdout
+
+    def terminate(self, pid, grace=10.0):
+        subprocess.run(["taskkill", "/PID", str(pid), "/T"], capture_output=True)
+        deadline = time.monotonic() + grace
+        while time.monotonic() < deadline:
+            if not self.alive(pid):
+                return True
+            time.sleep(0.2)
+        subprocess.run(["taskkill", "/F", "/PID", str(pid), "/T"], capture_output=True)
+        return True
+
+    def running(self):
+        r = subprocess.run(["tasklist", "/FI", f"IMAGENAME eq {self.name}", "/FO", "CSV"],
+                           capture_output=True, text=True)
+        return len(r.stdout.strip().split("\n")) > 1  # header + a process
+
+    def kill_all(self):
+        subprocess.run(["taskkill", "/F", "/IM", self.name], capture_output=True)
+
+
+PROCS = WindowsProcs() if WINDOWS else PosixProcs()
+
+def _detach():
+    return PROCS.detach()
+
+def _read_pid():
+    """Contents of the PID file, or None if missing / stale."""
+    try:
+        info = json.loads(PID_FILE.read_text())
+    except (OSError, ValueError):
+        return None
+    return info if PROCS.alive(int(info.get("supervisor", 0))) else None
+
+# ────────────────── supervisor ───────────────────────────────────────────
+
+class Supervisor:
+    """Owns the cloudflared connector for as long as it runs.
+
+    • drains the connector's output into a rotating log (tunnel.log)
+    • restarts it with exponential backoff when it exits
+    • serves cached state on http://STATUS_HOST:STATUS_PORT/status and
+      /health, so status checks don't spawn processes
+    • records its own and the connector's pid in tunnel.pid
+    """
+
+    def __init__(self, cmd, port=STATUS_PORT, log_file=LOG_FILE):
+        self.cmd, self.port = cmd, port
+        self.proc = None
+        self.state = {"state": "starting", "supervisor": os.getpid(), "pid": None,
+                      "restarts": 0, "started_at": None, "connected_at": None,
+                      "last_exit": None, "last_line": None}
+        self._lock = threading.Lock()
+        self._snapshot = json.dumps(self.state).encode()
+        self._stop = threading.Event()
+        self.log = logging.getLogger("tunnel")
+        self.log.propagate = False
+        if not self.log.handlers:
+            h = logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_MAX,
+                                                     backupCount=LOG_KEEP,
+                                                     encoding="utf-8")
+            h.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.log.addHandler(h)
+            self.log.setLevel(logging.INFO)
+
+    # state ---------------------------------------------------------------
+    def _set(self, **kv):
+        with self._lock:
+            self.state.update(kv)
+            self._snapshot = json.dumps(self.state).encode()
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot
+
+    # status endpoint -----------------------------------------------------
+    def _serve(self):
+        sup = self
+
+        class H(BaseHTTPRequestHandler):
+            def log_message(self, *_): ...
+
+            def do_GET(self):
+                body = sup.snapshot()
+                if self.path.startswith("/health"):
+                    ok = json.loads(body)["state"] == "running"
+                    code, body = (200, b"ok") if ok else (503, b"down")
+                elif self.path.startswith("/status"):
+                    code = 200
+                else:
+                    code, body = 404, b""
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.srv = ThreadingHTTPServer((STATUS_HOST, self.port), H)
+        self.srv.daemon_threads = True
+        threading.Thread(target=self.srv.serve_forever, daemon=True).start()
+
+    # connector -----------------------------------------------------------
+    # state: starting (spawned) → running (edge connection registered)
+    #        → backoff (exited, waiting to restart) → … → stopped
+    def _line(self, line):
+        self.log.info(line)
+        self._set(last_line=line[-300:])
+
+    def _spawn(self):
+        self.proc = subprocess.Popen(self.cmd, env=_env(), stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, text=True,
+                                     errors="replace", bufsize=1)
+        self.watch = ConnectorWatch(self.proc, self.proc.stdout, self._line)
+        self._set(state="starting", pid=self.proc.pid, started_at=time.time(),
+                  connected_at=None)
+        self._write_pid()
+        if self.watch.wait(READY_TIMEOUT, abort=self._stop):
+            self._set(state="running", connected_at=time.time())
+        elif not self._stop.is_set():
+            self.log.info(f"connector not ready: {self.watch.error}")
+            if self.proc.poll() is None:
+                self.proc.terminate()
+
+    def _write_pid(self):
+        tmp = PID_FILE.with_name(PID_FILE.name + ".part")
+        tmp.write_text(json.dumps({"supervisor": os.getpid(),
+                                   "pid": self.proc and self.proc.pid,
+                                   "port": self.port}))
+        os.replace(tmp, PID_FILE)
+
+    def stop(self, *_):
+        self._stop.set()
+
+    def run(self):
+        if _read_pid():
+            print("Supervisor already running")
+            return False
+        self._serve()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self.stop)
+        print(f"Supervising tunnel, status on http://{STATUS_HOST}:{self.port}/status")
+        backoff = 1
+        try:
+            while not self._stop.is_set():
+                self._spawn()
+                t0 = time.monotonic()
+                while self.proc.poll() is None and not self._stop.wait(0.5):
+                    pass
+                if self._stop.is_set():
+                    break
+                code = self.proc.returncode
+                if time.monotonic() - t0 > BACKOFF_MAX:
+                    backoff = 1              # it ran for a while – start over
+                self.log.info(f"connector exited with {code}, restart in {backoff}s")
+                self._set(state="backoff", pid=None, last_exit=code,
+                          restarts=self.state["restarts"] + 1)
+                if self._stop.wait(backoff):
+                    break
+                backoff = min(backoff * 2, BACKOFF_MAX)
+        finally:
+            if self.proc and self.proc.poll() is None:
+                self.proc.terminate()
+                try:
+                    self.proc.wait(10)
+                except subprocess.TimeoutExpired:
+                    self.proc.kill()
+            self._set(state="stopped", pid=None)
+            self.srv.shutdown()
+            PID_FILE.unlink(missing_ok=True)
+        return True
+
+def supervise(force=False):
+    """Bootstrap once, then keep the connector running."""
+    mode, cred = prepare(force)
+    return Supervisor(tunnel_cmd(mode, cred)).run()
+
+def supervisor_status(timeout=0.5):
+    """Cached state from a running supervisor, or None."""
+    try:
+        with urllib.request.urlopen(f"http://{STATUS_HOST}:{STATUS_PORT}/status",
+                                    timeout=timeout) as r:
+            return json.loads(r.read())
+    except (OSError, ValueError):
+        return None
+
 def check_tunnel():
     """Check if tunnel process is running."""
+    st = supervisor_status()
+    if st is not None:
+        return st.get("state") in UP_STATES
     try:
-        # Check if cloudflared process is running
-        result = subprocess.run(['tasklist', '/FI', 'IMAGENAME eq cloudflared.exe', '/FO', 'CSV'],
-                                capture_output=True, text=True)
-        
-        lines = result.stdout.strip().split('\n')
-        if len(lines) > 1:  # Header + at least one process
-            return True
-        return False
+        return PROCS.running()
     except Exception:
         return False
 
 def stop_tunnel():
-    """Stop all cloudflared processes."""
+    """Stop the supervisor (if any) and all cloudflared processes."""
     try:
-        subprocess.run(['taskkill', '/F', '/IM', 'cloudflared.exe'], 
-                       capture_output=True)
+        info = _read_pid()
+        if info:
+            PROCS.terminate(int(info["supervisor"]))
+        PROCS.kill_all()
         print("Tunnel stopped")
         return True
     except Exception as e:
@@ -149,13 +557,17 @@ def stop_tunnel():
 
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python tunnel.py [start|stop|status]")
+        print("Usage: python tunnel.py [start|supervise|stop|status] [--force-bootstrap]")
         return
     
     command = sys.argv[1]
+    force = "--force-bootstrap" in sys.argv[2:]
     
     if command == "start":
-        success = start_tunnel()
+        success = start_tunnel(force)
+        sys.exit(0 if success else 1)
+    elif command == "supervise":
+        success = supervise(force)
         sys.exit(0 if success else 1)
     elif command == "stop":
         success = stop_tunnel()
@@ -165,7 +577,7 @@ def main():
         print("running" if running else "stopped")
         sys.exit(0 if running else 1)
     else:
-        print("Invalid command. Use: start, stop, or status")
+        print("Invalid command. Use: start, supervise, stop, or status")
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -43,6 +43,7 @@
         'auto_start' => env('CLOUDFLARED_AUTO_START', true),
         'tunnel_url' => env('CLOUDFLARED_TUNNEL_URL', 'https://efactura.scyte.ro'),
         'executable_path' => env('CLOUDFLARED_PATH', base_path('cloudflared/cloudflared.exe')),
+        'status_port' => env('TUNNEL_STATUS_PORT', 8766),
     ],
 
 ];